@@ -7,11 +7,23 @@
 #
 
 import os
-
-from kano.utils import read_json, write_json, get_date_now, ensure_dir, \
-    chown_path, run_print_output_error, run_bg
+import time
+import copy
+import atexit
+import signal
+import threading
+
+from kano.utils import read_json, get_date_now, ensure_dir, \
+    run_print_output_error, run_bg
 from kano.logging import logger
-from .paths import apps_dir, xp_file, kanoprofile_dir, app_profiles_file
+from .paths import apps_dir, kanoprofile_dir, app_index_file
+from .storage import get_store, apply_changes
+from .cache import app_state_cache, app_list_cache, get_signature, is_racy
+from .atomic import write_json_atomic
+from .ownership import fix_ownership
+from .rules import load_rules
+
+ALL_APPS_KEY = None
 
 
 def get_app_dir(app_name):
@@ -26,23 +38,86 @@ def get_app_data_dir(app_name):
 
 
 def get_app_state_file(app_name):
+    """ Deprecated, use load_app_state() and save_app_state() instead.
+
+        Returns the path the state of an app had in the original JSON tree.
+        With the default SQLite store that file is only left behind as a
+        backup of the state before the migration, it's never updated.
+    """
+
     app_state_str = 'state.json'
     app_state_file = os.path.join(get_app_dir(app_name), app_state_str)
+
+    logger.warn('get_app_state_file() is deprecated, {} may not hold the '
+                'current state of {}'.format(app_state_file, app_name))
     return app_state_file
 
 
 def load_app_state(app_name):
-    app_state_file = get_app_state_file(app_name)
-    app_state = read_json(app_state_file)
-    if not app_state:
-        app_state = dict()
-    return app_state
+    if _write_behind is not None:
+        data = _write_behind.get(app_name)
+        if data is not None:
+            return data
+
+    store = get_store()
+    return app_state_cache.get(app_name, store.get_cache_paths(app_name),
+                               lambda: store.load(app_name))
+
+
+def load_all_app_states(include_buffered=True):
+    """ Load the states of all the apps in one go.
+
+        :param include_buffered: Whether to include the changes buffered in
+            memory by this process, see enable_write_behind().
+        :type include_buffered: Boolean
+
+        :returns: States indexed by the app name.
+        :rtype: dict
+    """
+
+    store = get_store()
+    states = app_state_cache.get(ALL_APPS_KEY, store.get_cache_paths(),
+                                 store.load_all)
+
+    if include_buffered and _write_behind is not None:
+        states.update(_write_behind.get_all())
+
+    return states
+
+
+def _invalidate_app_state(app_name):
+    app_state_cache.invalidate(app_name)
+    app_state_cache.invalidate(ALL_APPS_KEY)
+
+
+def lock_app_state(app_name):
+    """ Returns a lock guarding the state of an app, to be used in
+        a with statement around read-modify-write cycles.
+    """
+
+    return get_store().lock(app_name)
 
 
 def load_app_state_variable(app_name, variable):
-    data = load_app_state(app_name)
-    if variable in data:
-        return data[variable]
+    """ Load a single state variable of an app.
+
+        With the SQLite store only the one variable is read and parsed, so
+        the cost doesn't depend on the size of the rest of the state.
+
+        :returns: The value or None if it isn't set.
+    """
+
+    if _write_behind is not None:
+        data = _write_behind.get(app_name)
+        if data is not None:
+            return data.get(variable)
+
+    store = get_store()
+    data = app_state_cache.peek(app_name, store.get_cache_paths(app_name))
+    if data is not None:
+        return data.get(variable)
+
+    return store.load_variable(app_name, variable)
 
 
 def save_app_state(app_name, data):
@@ -57,15 +132,19 @@ def save_app_state(app_name, data):
 
     logger.debug('save_app_state {}'.format(app_name))
 
-    app_state_file = get_app_state_file(app_name)
     data['save_date'] = get_date_now()
-    ensure_dir(get_app_dir(app_name))
-    write_json(app_state_file, data)
-    if 'SUDO_USER' in os.environ:
-        chown_path(kanoprofile_dir)
-        chown_path(apps_dir)
-        chown_path(get_app_dir(app_name))
-        chown_path(app_state_file)
+
+    if _write_behind is not None:
+        _write_behind.put(app_name, data)
+    else:
+        _write_app_state(app_name, data)
+
+
+def _write_app_state(app_name, data):
+    _ensure_app_dir(app_name)
+    get_store().save(app_name, data)
+    _invalidate_app_state(app_name)
+    fix_ownership(kanoprofile_dir, apps_dir, get_app_dir(app_name))
 
 
 def save_app_state_variable(app_name, variable, value):
@@ -82,35 +161,330 @@ def save_app_state_variable(app_name, variable, value):
     msg = 'save_app_state_variable {} {} {}'.format(app_name, variable, value)
     logger.debug(msg)
 
-    data = load_app_state(app_name)
-    data[variable] = value
-
-    save_app_state(app_name, data)
+    update_app_state(app_name, updates={variable: value})
 
 
 def increment_app_state_variable(app_name, variable, value):
+    """ Atomically add a value to a numeric state variable.
+
+        The increment is appended to the app's journal of deltas without
+        taking the app's lock or rewriting its state, so it's safe to call
+        from several processes at once and cheap to call often.
+
+        :param app_name: The application that this variable is associated with.
+        :type app_name: str
+        :param variable: The name of the variable.
+        :type variable: str
+        :param value: The amount to add.
+        :type value: number
+    """
+
     logger.debug(
         'increment_app_state_variable {} {} {}'.format(
             app_name, variable, value))
 
-    data = load_app_state(app_name)
-    if variable not in data:
-        data[variable] = 0
-    data[variable] += value
+    if _write_behind is not None and _write_behind.increment(app_name,
+                                                             variable, value):
+        return
+
+    _ensure_app_dir(app_name)
+    get_store().increment(app_name, variable, value)
+    _invalidate_app_state(app_name)
+    fix_ownership(kanoprofile_dir, apps_dir, get_app_dir(app_name))
+
+
+def update_app_state(app_name, updates=None, increments=None):
+    """ Set and increment several variables of an app at once.
+
+        The state is read and written exactly once while holding the app's
+        lock, use this instead of a series of save_app_state_variable and
+        increment_app_state_variable calls. With the SQLite store only the
+        variables being changed are read and written.
+
+        :param app_name: The application that these variables belong to.
+        :type app_name: str
+        :param updates: Values to set, indexed by the variable name.
+        :type updates: dict
+        :param increments: Amounts to add, indexed by the variable name.
+            Variables that don't exist yet start from 0.
+        :type increments: dict
+    """
+
+    if _write_behind is not None:
+        _write_behind.update(app_name, updates, increments)
+        return
+
+    updates = dict(updates or {})
+    updates['save_date'] = get_date_now()
+
+    _ensure_app_dir(app_name)
+    get_store().update(app_name, updates, increments)
+    _invalidate_app_state(app_name)
+    fix_ownership(kanoprofile_dir, apps_dir, get_app_dir(app_name))
+
+
+class _WriteBehindBuffer(object):
+    """ Keeps the states saved by this process in memory and writes them
+        out later, at most once per app per flush.
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+        self._dirty = {}
+        self._lock = threading.RLock()
+        self._timer = None
+
+    def put(self, app_name, data):
+        """ Buffer a state. It keeps the journal mark it was loaded with,
+            so the flush only drops the increments folded into it.
+        """
+
+        with self._lock:
+            self._dirty[app_name] = copy.deepcopy(data)
+            _invalidate_app_state(app_name)
+
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def get(self, app_name):
+        with self._lock:
+            if app_name in self._dirty:
+                return copy.deepcopy(self._dirty[app_name])
+
+    def get_all(self):
+        with self._lock:
+            return copy.deepcopy(self._dirty)
+
+    def get_app_names(self):
+        with self._lock:
+            return self._dirty.keys()
+
+    def increment(self, app_name, variable, value):
+        """ Apply an increment to a buffered state.
+
+            :returns: False if the app isn't buffered.
+            :rtype: Boolean
+        """
+
+        with self._lock:
+            if app_name not in self._dirty:
+                return False
+
+            data = self._dirty[app_name]
+            if variable not in data:
+                data[variable] = 0
+            data[variable] += value
+            _invalidate_app_state(app_name)
+            return True
+
+    def update(self, app_name, updates=None, increments=None):
+        """ Apply changes to the buffered state of an app, loading it first
+            if it isn't buffered yet. Only memory is touched, so no lock on
+            the stored state is needed.
+        """
+
+        with self._lock:
+            data = self.get(app_name)
+            if data is None:
+                data = load_app_state(app_name)
+            apply_changes(data, updates, increments)
+            save_app_state(app_name, data)
+
+    def flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+            dirty = self._dirty
+            self._dirty = {}
+
+            for app_name, data in dirty.iteritems():
+                logger.debug('flushing buffered state of {}'.format(app_name))
+                _write_app_state(app_name, data)
+
+
+_write_behind = None
+_previous_sigterm_handler = None
+
+
+def enable_write_behind(delay=5):
+    """ Buffer the app states saved by this process in memory.
+
+        Repeated saves of the same app are coalesced into a single write
+        which happens at most `delay` seconds after the first unsaved
+        change, when flush_app_states() is called, or when the process
+        exits or receives SIGTERM. Meant for games that save their state
+        very often. Loads in this process see the buffered states, other
+        processes only see them once they are flushed.
+
+        :param delay: Longest time a change stays in memory, in seconds.
+        :type delay: number
+    """
+
+    global _write_behind, _previous_sigterm_handler
+
+    if _write_behind is not None:
+        _write_behind.delay = delay
+        return
+
+    _write_behind = _WriteBehindBuffer(delay)
+
+    if _previous_sigterm_handler is not None:
+        # Enabled before, the exit hooks are already in place
+        return
+
+    atexit.register(flush_app_states)
+
+    try:
+        _previous_sigterm_handler = signal.signal(signal.SIGTERM,
+                                                  _flush_on_sigterm)
+    except ValueError:
+        # Signal handlers can only be installed from the main thread
+        logger.warn('Buffered app states will not be flushed on SIGTERM')
+        _previous_sigterm_handler = signal.SIG_DFL
+
+
+def get_buffered_app_names():
+    """ Returns the apps whose states are buffered in memory and not yet
+        written out.
+    """
+
+    if _write_behind is None:
+        return []
+
+    return _write_behind.get_app_names()
+
+
+def disable_write_behind():
+    """ Flush the buffered app states and go back to writing them out
+        immediately.
+    """
+
+    global _write_behind
+
+    flush_app_states()
+    _write_behind = None
 
-    save_app_state(app_name, data)
+
+def flush_app_states():
+    """ Write out the app states buffered by enable_write_behind(). """
+
+    if _write_behind is not None:
+        _write_behind.flush()
+
+
+def _flush_on_sigterm(signum, frame):
+    flush_app_states()
+
+    if callable(_previous_sigterm_handler):
+        _previous_sigterm_handler(signum, frame)
+    elif _previous_sigterm_handler != signal.SIG_IGN:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        os.kill(os.getpid(), signal.SIGTERM)
 
 
 def get_app_list():
+    """ Returns the names of all the apps that have a directory in the
+        profile.
+
+        The list is kept in an index file along with the signature of the
+        apps directory, so it is only rebuilt after a directory has been
+        added or removed. It is also cached within the process, see
+        invalidate_app_list().
+
+        :returns: App names.
+        :rtype: list
+    """
+
+    return app_list_cache.get(ALL_APPS_KEY, [apps_dir], _load_app_list)
+
+
+def invalidate_app_list():
+    """ Forget the cached list of apps and rebuild the index file. """
+
+    app_list_cache.invalidate()
+    if os.path.exists(app_index_file):
+        os.remove(app_index_file)
+
+
+def _load_app_list():
+    apps = _read_app_index(get_signature([apps_dir]))
+    if apps is None:
+        apps = _rebuild_app_list()
+    return apps
+
+
+def _read_app_index(signature):
+    """ Returns the apps from the index file, None if the index is
+        missing or was built for a different signature.
+    """
+
+    index = read_json(app_index_file)
+    if not index:
+        return None
+
+    # JSON turns the tuples into lists
+    index_signature = tuple(tuple(entry) if entry else entry
+                            for entry in index['signature'])
+    if index_signature != signature:
+        return None
+
+    return index['apps']
+
+
+def _rebuild_app_list():
+    signature = get_signature([apps_dir])
+    scanned_at = time.time()
+
     if not os.path.exists(apps_dir):
-        return []
+        apps = []
     else:
-        return [p for p in os.listdir(apps_dir)
+        apps = [p for p in os.listdir(apps_dir)
                 if os.path.isdir(os.path.join(apps_dir, p))]
 
+    _write_app_index(apps, signature, scanned_at)
+    return apps
+
+
+def _write_app_index(apps, signature, scanned_at):
+    # A directory created in the same tick as the scan wouldn't change
+    # the signature, don't persist such an index
+    if is_racy(signature, scanned_at) or not os.path.exists(kanoprofile_dir):
+        return
+
+    try:
+        write_json_atomic(app_index_file, {
+            'signature': signature,
+            'apps': apps
+        })
+    except (IOError, OSError) as e:
+        logger.warn('Unable to write the app index: {}'.format(e))
+        return
+    fix_ownership(app_index_file)
+
+
+def _ensure_app_dir(app_name):
+    """ Create the directory of an app.
+
+        The app index isn't updated in place: the new directory has just
+        changed the signature of the apps directory, which is too recent to
+        be trusted, see _write_app_index(). The index is rebuilt on the next
+        scan instead.
+    """
+
+    app_dir = get_app_dir(app_name)
+    if os.path.isdir(app_dir):
+        return
+
+    ensure_dir(app_dir)
+    app_list_cache.invalidate()
+
 
 def get_gamestate_variables(app_name):
-    allrules = read_json(xp_file)
+    allrules = load_rules()['xp']
     if not allrules:
         return list()
 
@@ -124,7 +498,7 @@ def get_gamestate_variables(app_name):
 def launch_project(app, filename, data_dir, background=False):
     logger.info('launch_project: {} {} {}'.format(app, filename, data_dir))
 
-    app_profiles = read_json(app_profiles_file)
+    app_profiles = load_rules()['app_profiles']
 
     fullpath = os.path.join(data_dir, filename)
     cmd = app_profiles[app]['cmd'].format(fullpath=fullpath, filename=filename)
@@ -137,7 +511,7 @@ def launch_project(app, filename, data_dir, background=False):
 
 
 def get_app_xp_for_challenge(app, challenge_no):
-    xp_file_json = read_json(xp_file)
+    xp_file_json = load_rules()['xp']
 
     try:
         return xp_file_json[app]['level'][challenge_no]
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+# atomic.py
+#
+# Copyright (C) 2015 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+
+"""
+Crash-safe file writes
+
+Files are written to a temporary file in the same directory which is then
+renamed over the original, so a power cut leaves either the old or the new
+version on disk, never a truncated one. How hard we push the data to the
+SD card is controlled by the fsync policy.
+"""
+
+import os
+import json
+import tempfile
+
+from kano.logging import logger
+
+FSYNC_NONE = 'none'
+FSYNC_DATA = 'fdatasync'
+FSYNC_FULL = 'fsync'
+
+FSYNC_POLICIES = [FSYNC_NONE, FSYNC_DATA, FSYNC_FULL]
+FSYNC_ENV_VAR = 'KANO_PROFILE_FSYNC'
+
+_policy = os.environ.get(FSYNC_ENV_VAR, FSYNC_DATA)
+if _policy not in FSYNC_POLICIES:
+    logger.warn('Unknown fsync policy {}'.format(_policy))
+    _policy = FSYNC_DATA
+
+_sync_dirs = _policy != FSYNC_NONE
+
+_stats = {
+    'writes': 0,
+    'bytes': 0,
+    'fsyncs': 0
+}
+
+
+def set_fsync_policy(policy, sync_dirs=None):
+    """ Choose how the data is flushed to the disk after a write.
+
+        :param policy: One of FSYNC_NONE, FSYNC_DATA (the default, can also
+            be set with the KANO_PROFILE_FSYNC environment variable) and
+            FSYNC_FULL.
+        :type policy: str
+
+        :param sync_dirs: Also fsync the directory after the rename so the
+            new name is durable. On by default unless the policy is
+            FSYNC_NONE.
+        :type sync_dirs: Boolean
+    """
+
+    global _policy, _sync_dirs
+
+    if policy not in FSYNC_POLICIES:
+        raise ValueError('Unknown fsync policy {}'.format(policy))
+
+    _policy = policy
+    if sync_dirs is None:
+        sync_dirs = policy != FSYNC_NONE
+    _sync_dirs = sync_dirs
+
+
+def get_fsync_policy():
+    return _policy
+
+
+def get_write_stats():
+    """ Returns the totals of the atomic writes done by this process.
+
+        :returns: Number of writes, bytes written and fsync calls.
+        :rtype: dict
+    """
+
+    return dict(_stats)
+
+
+def _sync_file(fd):
+    if _policy == FSYNC_FULL:
+        os.fsync(fd)
+    elif _policy == FSYNC_DATA:
+        # Not available everywhere, e.g. OS X
+        getattr(os, 'fdatasync', os.fsync)(fd)
+    else:
+        return 0
+    return 1
+
+
+def _sync_dir(path):
+    if not _sync_dirs:
+        return 0
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return 1
+
+
+def _get_mode(path):
+    try:
+        return os.stat(path).st_mode & 0777
+    except OSError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0666 & ~umask
+
+
+def write_file_atomic(path, contents):
+    """ Atomically replace the contents of a file.
+
+        The permissions of an existing file are kept, new files get the
+        default ones, as with open().
+
+        :param path: The file to write.
+        :type path: str
+
+        :param contents: The new contents.
+        :type contents: str
+
+        :returns: Number of bytes written and fsync calls made.
+        :rtype: tuple
+    """
+
+    if isinstance(contents, unicode):
+        contents = contents.encode('utf-8')
+
+    dir_path = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path,
+                                    prefix='.{}.'.format(os.path.basename(path)),
+                                    suffix='.tmp')
+    fsyncs = 0
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            os.fchmod(tmp_file.fileno(), _get_mode(path))
+            tmp_file.write(contents)
+            tmp_file.flush()
+            fsyncs += _sync_file(tmp_file.fileno())
+
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+    fsyncs += _sync_dir(dir_path)
+
+    _stats['writes'] += 1
+    _stats['bytes'] += len(contents)
+    _stats['fsyncs'] += fsyncs
+    logger.debug('atomic write of {}: {} bytes, {} fsyncs'.format(
+        path, len(contents), fsyncs))
+
+    return len(contents), fsyncs
+
+
+def write_json_atomic(path, data):
+    """ Atomically replace a JSON file, formatted like write_json(). """
+
+    return write_file_atomic(path, json.dumps(data, indent=2,
+                                              sort_keys=True))
@@ -9,182 +9,398 @@
 from __future__ import division
 
 import os
+import copy
 import json
+import time
 
 from kano.logging import logger
-from kano.utils import read_json, is_gui, is_running, run_bg
-from .paths import xp_file, levels_file, rules_dir, bin_dir, \
-    app_profiles_file, online_badges_dir, online_badges_file
-from .apps import load_app_state, get_app_list, save_app_state
-from .quests import Quests
+from kano.utils import is_gui, is_running, run_bg
+from .paths import bin_dir, online_badges_dir, online_badges_file
+from .apps import load_app_state, load_all_app_states, save_app_state, \
+    save_app_state_variable, increment_app_state_variable, \
+    get_buffered_app_names
+from .quests import Quests, QUESTS_STORE
+from .storage import get_store, apply_changes
+from .cache import app_state_cache, get_signature, is_racy
+from .xp import calculate_app_xp
+from .stats import get_app_xps, get_stats_index
+from .rules import load_rules, get_rule_sources, get_level_info, \
+    is_badge_achieved, is_pushed_back, is_offline_badge
+
+
+class _lazy_property(object):
+    """ A property computed on first access and then stored in the
+        instance.
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        value = self.func(instance)
+        instance.__dict__[self.__name__] = value
+        return value
+
+
+def _get_rule_files():
+    return get_rule_sources() + [QUESTS_STORE]
+
+
+class ProfileSnapshot(object):
+    """ The XP, level and badges of the user at one point in time.
+
+        The rules and the states of the apps are read once, when they are
+        first needed, and the values are computed from them on demand and
+        remembered. Use one snapshot for everything you need to show at
+        once rather than separate calculate_*() calls, which each read all
+        the files again.
+
+        The values are shared, don't modify them.
+    """
+
+    def __init__(self, app_states=None):
+        """
+            :param app_states: Evaluate these states instead of the saved
+                ones.
+            :type app_states: dict
+        """
+
+        self.created_at = time.time()
+        self.generation = app_state_cache.generation
+
+        # Given states don't touch the store, they may not be the user's
+        if app_states is not None:
+            self.app_states = app_states
+            self.signature = None
+        else:
+            self.signature = get_signature(get_store().get_cache_paths() +
+                                           _get_rule_files())
 
+    def is_current(self):
+        """ Whether nothing the snapshot was computed from changed since. """
 
-def calculate_xp():
-    allrules = read_json(xp_file)
-    if not allrules:
-        return -1
+        return self.signature is not None and \
+            self.generation == app_state_cache.generation and \
+            not is_racy(self.signature, self.created_at) and \
+            self.signature == get_signature(get_store().get_cache_paths() +
+                                            _get_rule_files())
 
-    points = 0
+    @_lazy_property
+    def app_states(self):
+        return load_all_app_states()
 
-    for app, groups in allrules.iteritems():
-        appstate = load_app_state(app)
-        if not appstate:
-            continue
+    @_lazy_property
+    def rules(self):
+        return load_rules()
 
-        for group, rules in groups.iteritems():
-            # calculating points based on level
-            if group == 'level' and 'level' in appstate:
-                maxlevel = int(appstate['level'])
+    @property
+    def xp_rules(self):
+        return self.rules['xp']
 
-                for level, value in rules.iteritems():
-                    level = int(level)
-                    value = int(value)
+    @property
+    def level_rules(self):
+        return self.rules['levels']
+
+    @property
+    def app_profiles(self):
+        return self.rules['app_profiles']
+
+    @property
+    def badge_rules(self):
+        return self.rules['badges']
+
+    @_lazy_property
+    def quests(self):
+        return Quests()
+
+    @_lazy_property
+    def app_xps(self):
+        """ The XP each app contributes, before rounding.
+
+            Unless the states were given or have already been loaded, the
+            contributions come from the stats index.
+        """
+
+        allrules = self.xp_rules
+        if not allrules:
+            return dict()
+
+        if 'app_states' in self.__dict__:
+            return dict((app, calculate_app_xp(groups,
+                                               self.app_states.get(app)))
+                        for app, groups in allrules.iteritems())
 
-                    if level <= maxlevel:
-                        points += value
+        app_xps = get_app_xps(_load_saved_app_states)
+        for app in get_buffered_app_names():
+            if app in allrules:
+                app_xps[app] = calculate_app_xp(allrules[app],
+                                                load_app_state(app))
+        return app_xps
 
-            # calculating points based on multipliers
-            if group == 'multipliers':
-                for thing, value in rules.iteritems():
-                    value = float(value)
-                    if thing in appstate:
-                        points += value * appstate[thing]
+    @_lazy_property
+    def xp(self):
+        """ The total XP of the user, -1 if the rules are missing. """
 
-    qm = Quests()
-    return int(points) + qm.evaluate_xp()
+        if not self.xp_rules:
+            return -1
 
+        return int(sum(self.app_xps.itervalues())) + self.quests.evaluate_xp()
 
-def calculate_kano_level():
-    '''
-    Calculates the current level of the user
-    Returns: level, percentage and current xp
-    '''
-    level_rules = read_json(levels_file)
-    if not level_rules:
-        return -1, 0, 0
+    @_lazy_property
+    def level_info(self):
+        """ See get_level_info(), None if the rules are missing. """
 
-    max_level = max([int(n) for n in level_rules.keys()])
-    xp_now = calculate_xp()
+        if not self.rules['level_table']:
+            return None
 
-    for level in xrange(1, max_level + 1):
-        level_min = level_rules[str(level)]
+        return get_level_info(self.rules['level_table'], self.xp)
 
-        if level != max_level:
-            level_max = level_rules[str(level + 1)] - 1
-        else:
-            level_max = float("inf")
+    @property
+    def level(self):
+        """ The level, the progress towards the next one and the XP. """
 
-        if level_min <= xp_now <= level_max:
-            reached_level = level
-            reached_percentage = (xp_now - level_min) / (level_max + 1 - level_min)
+        if self.level_info is None:
+            return -1, 0, 0
 
-            return int(reached_level), reached_percentage, xp_now
+        level, progress, _, _ = self.level_info
+        return level, progress, self.xp
 
+    @property
+    def xp_range(self):
+        """ The XP the current level starts at, the XP now and the XP the
+            next level starts at.
+        """
 
-def calculate_min_current_max_xp():
-    level_rules = read_json(levels_file)
-    if not level_rules:
-        return -1, 0
+        if self.level_info is None:
+            return -1, 0
 
-    max_level = max([int(n) for n in level_rules.keys()])
-    xp_now = calculate_xp()
+        _, _, level_min, level_max = self.level_info
+        return level_min, self.xp, level_max
 
-    level_min = 0
-    level_max = 0
+    @property
+    def badge_dependencies(self):
+        return self.rules['dependencies']
 
-    for level in xrange(1, max_level + 1):
-        level_min = level_rules[str(level)]
+    def _get_evaluation_state(self):
+        """ The app states the badge rules are evaluated against, including
+            the computed kano_level. The num_offline_badges variable depends
+            on the results of the other rules, it's added in between.
+        """
 
-        if level != max_level:
-            level_max = level_rules[str(level + 1)]
-        else:
-            level_max = float("inf")
+        app_state = dict(self.app_states)
+        app_state['computed'] = dict(app_state.get('computed', dict()))
+        app_state['computed']['kano_level'] = self.level[0]
+        return app_state
 
-        if level_min <= xp_now <= level_max:
-            return level_min, xp_now, level_max
+    @_lazy_property
+    def badges(self):
+        """ All the badges and environments, with an 'achieved' flag. """
 
+        # helper function to calculate operations
+        def do_calculate(select_push_back):
+            for category, subcats in all_rules.iteritems():
+                for subcat, items in subcats.iteritems():
+                    for item, rules in items.iteritems():
+                        if is_pushed_back(rules) != select_push_back:
+                            continue
 
-def calculate_badges():
-    # helper function to calculate operations
-    def do_calculate(select_push_back):
-        for category, subcats in all_rules.iteritems():
-            for subcat, items in subcats.iteritems():
-                for item, rules in items.iteritems():
-                    target_pushback = 'push_back' in rules and rules['push_back'] is True
-                    if target_pushback != select_push_back:
-                        continue
-
-                    if rules['operation'] == 'each_greater':
-                        achieved = True
-                        for target in rules['targets']:
-                            app = target[0]
-                            variable = target[1]
-                            value = target[2]
-
-                            if variable == 'level' and value == -1:
-                                value = app_profiles[app]['max_level']
-                            if app not in app_list or variable not in app_state[app]:
-                                achieved = False
-                                break
-                            achieved &= app_state[app][variable] >= value
-
-                    elif rules['operation'] == 'sum_greater':
-                        sum = 0
-                        for target in rules['targets']:
-                            app = target[0]
-                            variable = target[1]
-
-                            if app not in app_list or variable not in app_state[app]:
-                                continue
-
-                            sum += float(app_state[app][variable])
-
-                        achieved = sum >= rules['value']
-
-                    else:
-                        continue
-
-                    calculated_badges.setdefault(category, dict()).setdefault(subcat, dict())[item] \
-                        = all_rules[category][subcat][item]
-                    calculated_badges[category][subcat][item]['achieved'] = achieved
-
-    def count_offline_badges():
-        count = 0
-        for category, subcats in calculated_badges.iteritems():
-            for subcat, items in subcats.iteritems():
-                for item, rules in items.iteritems():
-                    if category == 'badges' and subcat != 'online' and rules['achieved']:
-                        count += 1
-        return count
+                        achieved = is_badge_achieved(rules, app_state,
+                                                     app_profiles)
+                        if achieved is None:
+                            continue
+
+                        badge = dict(rules)
+                        badge['achieved'] = achieved
+                        calculated_badges.setdefault(category, dict()).setdefault(subcat, dict())[item] \
+                            = badge
+
+        app_profiles = self.app_profiles
+        app_state = self._get_evaluation_state()
+
+        all_rules = self.badge_rules
+        calculated_badges = dict()
+
+        # normal ones
+        do_calculate(False)
+
+        # count offline badges
+        app_state['computed']['num_offline_badges'] = \
+            _count_offline_badges(calculated_badges)
+
+        # add pushed back ones
+        do_calculate(True)
+
+        # Inject badges from quests to the dict
+        calculated_badges['badges']['quests'] = self.quests.evaluate_badges()
+
+        return calculated_badges
+
+    def with_app_state(self, app_name, app_state):
+        """ Returns a snapshot that differs from this one only in the state
+            of one app. The rules and the XP of the other apps are reused.
+            The quests are read again, so the badges they award are compared
+            between the two snapshots too.
+
+            :param app_name: The app to replace the state of.
+            :type app_name: str
+
+            :param app_state: The new state of the app.
+            :type app_state: dict
+
+            :rtype: ProfileSnapshot
+        """
+
+        app_states = dict(self.app_states)
+        app_states[app_name] = app_state
+
+        snapshot = ProfileSnapshot(app_states)
+        snapshot.rules = self.rules
+
+        app_xps = dict(self.app_xps)
+        if app_name in app_xps:
+            app_xps[app_name] = calculate_app_xp(self.xp_rules[app_name],
+                                                 app_state)
+        snapshot.app_xps = app_xps
+
+        return snapshot
+
+    def get_new_badges(self, old):
+        """ Returns the badges achieved since an older snapshot.
+
+            Only the rules that depend on the variables which changed in
+            between are evaluated, against both snapshots. The whole set is
+            only compared when the number of offline badges changed, as
+            some rules depend on that.
+
+            :param old: The snapshot to compare with.
+            :type old: ProfileSnapshot
+
+            :returns: Newly achieved badges, as compare_badges_dict().
+            :rtype: dict
+        """
+
+        if 'badges' in old.__dict__ and 'badges' in self.__dict__:
+            return compare_badges_dict(old.badges, self.badges)
+
+        changed = get_changed_variables(old.app_states, self.app_states)
+        if old.level[0] != self.level[0]:
+            changed.add(('computed', 'kano_level'))
+
+        affected = set()
+        for key in changed:
+            affected.update(self.badge_dependencies.get(key, []))
+
+        old_state = old._get_evaluation_state()
+        new_state = self._get_evaluation_state()
+
+        changes = dict()
+        for category, subcat, item in affected:
+            rules = self.badge_rules[category][subcat][item]
+            if is_pushed_back(rules):
+                # These can depend on num_offline_badges which is only
+                # known after evaluating everything else
+                return compare_badges_dict(old.badges, self.badges)
+
+            was_achieved = is_badge_achieved(rules, old_state,
+                                             old.app_profiles)
+            achieved = is_badge_achieved(rules, new_state, self.app_profiles)
+            if was_achieved == achieved or achieved is None:
+                continue
+
+            if is_offline_badge(category, subcat):
+                return compare_badges_dict(old.badges, self.badges)
+
+            if was_achieved is False and achieved is True:
+                badge = dict(rules)
+                badge['achieved'] = True
+                changes.setdefault(category, dict()).setdefault(subcat, dict())[item] \
+                    = badge
+
+        quest_changes = compare_badges_dict(
+            {'badges': {'quests': old.quests.evaluate_badges()}},
+            {'badges': {'quests': self.quests.evaluate_badges()}})
+        if quest_changes:
+            changes.setdefault('badges', dict()).update(
+                quest_changes['badges'])
+
+        return changes
+
+
+def _count_offline_badges(calculated_badges):
+    count = 0
+    for category, subcats in calculated_badges.iteritems():
+        for subcat, items in subcats.iteritems():
+            for item, rules in items.iteritems():
+                if is_offline_badge(category, subcat) and rules['achieved']:
+                    count += 1
+    return count
+
+
+def get_changed_variables(old_states, new_states):
+    """ Compares two sets of app states.
+
+        :returns: (app, variable) of all the variables that differ.
+        :rtype: set
+    """
+
+    changed = set()
+    for app in set(old_states) | set(new_states):
+        old = old_states.get(app) or dict()
+        new = new_states.get(app) or dict()
+        if old == new:
+            continue
+
+        for variable in set(old) | set(new):
+            if variable not in old or variable not in new or \
+                    old[variable] != new[variable]:
+                changed.add((app, variable))
+    return changed
+
+
+_shared_snapshot = None
+
+
+def get_profile_snapshot():
+    """ Returns a snapshot of the current profile.
 
-    app_profiles = read_json(app_profiles_file)
-    if not app_profiles:
-        logger.error('Error reading app_profiles.json')
+        The same snapshot is handed out for as long as neither the states
+        of the apps nor the rules change, so the XP, level and badges are
+        only computed once however many parts of the program ask for them.
 
-    app_list = get_app_list() + ['computed']
-    app_state = dict()
-    for app in app_list:
-        app_state[app] = load_app_state(app)
+        :rtype: ProfileSnapshot
+    """
 
-    app_state.setdefault('computed', dict())['kano_level'] = calculate_kano_level()[0]
+    global _shared_snapshot
 
-    all_rules = load_badge_rules()
-    calculated_badges = dict()
+    if _shared_snapshot is None or not _shared_snapshot.is_current():
+        _shared_snapshot = ProfileSnapshot()
 
-    # normal ones
-    do_calculate(False)
+    return _shared_snapshot
 
-    # count offline badges
-    app_state['computed']['num_offline_badges'] = count_offline_badges()
 
-    # add pushed back ones
-    do_calculate(True)
+def calculate_xp():
+    return get_profile_snapshot().xp
 
-    # Inject badges from quests to the dict
-    qm = Quests()
-    calculated_badges['badges']['quests'] = qm.evaluate_badges()
 
-    return calculated_badges
+def calculate_kano_level():
+    '''
+    Calculates the current level of the user
+    Returns: level, percentage and current xp
+    '''
+    return get_profile_snapshot().level
+
+
+def calculate_min_current_max_xp():
+    return get_profile_snapshot().xp_range
+
+
+def calculate_badges():
+    return copy.deepcopy(get_profile_snapshot().badges)
 
 
 def compare_badges_dict(old, new):
@@ -222,24 +438,63 @@ def load_online_badges():
     return online_badges
 
 
+def evaluate_change(app_name, updates=None, increments=None):
+    """ Works out what a change of an app's state would earn the user,
+        without saving anything.
+
+        :param app_name: The app whose state would change.
+        :type app_name: str
+        :param updates: Values to set, indexed by the variable name.
+        :type updates: dict
+        :param increments: Amounts to add, indexed by the variable name.
+        :type increments: dict
+
+        :returns: The XP and level before and after the change under 'old_xp',
+            'new_xp', 'old_level' and 'new_level', their difference under
+            'xp_diff' and the badges that would be unlocked under
+            'new_badges' (as compare_badges_dict()).
+        :rtype: dict
+    """
+
+    snapshot = get_profile_snapshot()
+    app_state = copy.deepcopy(snapshot.app_states.get(app_name, dict()))
+    apply_changes(app_state, updates, increments)
+
+    return _evaluate_app_state(snapshot, app_name, app_state)
+
+
+def _evaluate_app_state(snapshot, app_name, app_state):
+    new_snapshot = snapshot.with_app_state(app_name, app_state)
+
+    return {
+        'old_xp': snapshot.xp,
+        'new_xp': new_snapshot.xp,
+        'xp_diff': new_snapshot.xp - snapshot.xp,
+        'old_level': snapshot.level[0],
+        'new_level': new_snapshot.level[0],
+        'new_badges': new_snapshot.get_new_badges(snapshot)
+    }
+
+
 def save_app_state_with_dialog(app_name, data):
     logger.debug('save_app_state_with_dialog {}'.format(app_name))
 
-    old_level, _, old_xp = calculate_kano_level()
-    old_badges = calculate_badges()
-
+    change = _evaluate_app_state(get_profile_snapshot(), app_name,
+                                 copy.deepcopy(data))
     save_app_state(app_name, data)
+    _show_change_dialog(change)
 
-    new_level, _, new_xp = calculate_kano_level()
-    new_badges = calculate_badges()
+    return change
 
+
+def _show_change_dialog(change):
     # TODO: This function needs a bit of refactoring in the future
     # The notifications no longer need to be concatenated to a string
 
     # new level
     new_level_str = ''
-    if old_level != new_level:
-        new_level_str = 'level:{}'.format(new_level)
+    if change['old_level'] != change['new_level']:
+        new_level_str = 'level:{}'.format(change['new_level'])
 
         # A new level has been reached, update the desktop profile icon
         if os.path.exists('/usr/bin/kdesk') and not is_running('kano-sync'):
@@ -248,7 +503,7 @@ def save_app_state_with_dialog(app_name, data):
 
     # new items
     new_items_str = ''
-    badge_changes = compare_badges_dict(old_badges, new_badges)
+    badge_changes = change['new_badges']
     if badge_changes:
         for category, subcats in badge_changes.iteritems():
             for subcat, items in subcats.iteritems():
@@ -256,7 +511,7 @@ def save_app_state_with_dialog(app_name, data):
                     new_items_str += ' {}:{}:{}'.format(category, subcat, item)
 
     # Check if XP has changed, if so play sound in the backgrond
-    if old_xp != new_xp:
+    if change['xp_diff']:
         sound_cmd = 'aplay /usr/share/kano-media/sounds/kano_xp.wav > /dev/null 2>&1 &'
         run_bg(sound_cmd)
 
@@ -277,75 +532,48 @@ def save_app_state_with_dialog(app_name, data):
 def save_app_state_variable_with_dialog(app_name, variable, value):
     logger.debug('save_app_state_variable_with_dialog {} {} {}'.format(app_name, variable, value))
 
-    data = load_app_state(app_name)
-    data[variable] = value
+    change = evaluate_change(app_name, updates={variable: value})
+    save_app_state_variable(app_name, variable, value)
+    _show_change_dialog(change)
 
-    save_app_state_with_dialog(app_name, data)
+    return change
 
 
 def increment_app_state_variable_with_dialog(app_name, variable, value):
     logger.debug('increment_app_state_variable_with_dialog {} {} {}'.format(app_name, variable, value))
 
-    data = load_app_state(app_name)
-    if variable not in data:
-        data[variable] = 0
-    data[variable] += value
+    change = evaluate_change(app_name, increments={variable: value})
+    increment_app_state_variable(app_name, variable, value)
+    _show_change_dialog(change)
 
-    save_app_state_with_dialog(app_name, data)
+    return change
 
 
 def load_badge_rules():
-    if not os.path.exists(rules_dir):
-        logger.error('rules dir missing')
+    rules = load_rules()['badges']
+    if rules is None:
         return
 
-    merged_rules = dict()
-    subfolders = ['badges', 'environments']
-    for folder in subfolders:
-        folder_fullpath = os.path.join(rules_dir, folder)
-        if not os.path.exists(folder_fullpath):
-            logger.error('rules subfolder missing: {}'.format(folder_fullpath))
-            return
-
-        rule_files = os.listdir(folder_fullpath)
-        if not rule_files:
-            logger.error('no rule files in subfolder: {}'.format(folder_fullpath))
-            return
-
-        for rule_file in rule_files:
-            rule_file_fullpath = os.path.join(folder_fullpath, rule_file)
-            rule_data = read_json(rule_file_fullpath)
-            if not rule_data:
-                logger.error('rule file empty: {}'.format(rule_file_fullpath))
-                continue
+    return copy.deepcopy(rules)
 
-            category = folder
-            subcategory = rule_file.split('.')[0]
 
-            merged_rules.setdefault(category, dict())[subcategory] = rule_data
-    return merged_rules
+def _load_saved_app_states():
+    return load_all_app_states(include_buffered=False)
 
 
-def count_completed_challenges():
-    allrules = read_json(xp_file)
-    if not allrules:
-        return -1
+def _get_stats_index():
+    # The index doesn't know about the states buffered in memory yet
+    if get_buffered_app_names():
+        return None
 
-    completed_challenges = 0
+    return get_stats_index(_load_saved_app_states)
 
-    for app, groups in allrules.iteritems():
-        appstate = load_app_state(app)
-        try:
-            completed_challenges += int(appstate['level'])
-        except Exception:
-            pass
 
-    return completed_challenges
+def count_completed_challenges():
+    return count_stat('level')
 
 
 def count_badges():
-    all_badges = calculate_badges()
-
     locked = {
         'badges': 0,
         'environments': 0,
@@ -356,26 +584,42 @@ def count_badges():
         'environments': 0,
     }
 
-    for category, subcats in all_badges.iteritems():
-        for subcat, items in subcats.iteritems():
-            for item, rules in items.iteritems():
-                if rules['achieved']:
-                    unlocked[category] += 1
-                else:
-                    locked[category] += 1
+    index = _get_stats_index()
+    if index is not None:
+        achieved_flags = [(key.split('/', 1)[0], achieved)
+                          for key, achieved in index['badges'].iteritems()]
+        achieved_flags += [('badges', badge['achieved'])
+                           for badge in Quests().evaluate_badges().itervalues()]
+    else:
+        achieved_flags = [(category, rules['achieved'])
+                          for category, subcats in get_profile_snapshot().badges.iteritems()
+                          for items in subcats.itervalues()
+                          for rules in items.itervalues()]
+
+    for category, achieved in achieved_flags:
+        if achieved:
+            unlocked[category] += 1
+        else:
+            locked[category] += 1
 
     return dict(unlocked), dict(locked)
 
 
 def count_stat(key):
-    allrules = read_json(xp_file)
+    allrules = load_rules()['xp']
     if not allrules:
         return -1
 
+    index = _get_stats_index()
+    if index is not None:
+        return sum(stats['counts'].get(key, 0)
+                   for stats in index['apps'].itervalues())
+
     count = 0
+    app_states = get_profile_snapshot().app_states
 
     for app, _ in allrules.iteritems():
-        appstate = load_app_state(app)
+        appstate = app_states.get(app, dict())
         try:
             count += int(appstate[key])
         except Exception:
@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+
+# bulk.py
+#
+# Copyright (C) 2015 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+
+"""
+Evaluating many exported profiles at once
+
+Meant for collecting reports from a fleet of devices. The .kanoprofile
+trees are loaded into columns, one per (app, variable) the rules refer to,
+and the XP, the levels and the badges of all the profiles are computed
+with vectorised NumPy operations. NumPy is optional, without it each
+profile is evaluated with a ProfileSnapshot instead.
+
+The profiles are opened strictly read-only, they may be copies on
+read-only media or belong to other users. Nothing is written into the
+profile of whoever runs the report either. The quests aren't taken into
+account, they depend on the device.
+"""
+
+import os
+import csv
+import pwd
+import json
+import multiprocessing
+
+from kano.logging import logger
+from .paths import ProfilePaths
+from .storage import JsonTreeStore, SqliteStore, sqlite3
+from .rules import load_rules, is_pushed_back, is_offline_badge
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SUMMARY_FIELDS = ['profile', 'xp', 'level', 'progress', 'badges',
+                  'environments', 'runtime', 'starts', 'top_app']
+
+
+def find_profiles(paths):
+    """ Finds the profiles under the given paths.
+
+        A path can be a .kanoprofile directory, a home directory containing
+        one, or a directory with many of those (one per device).
+
+        :returns: The .kanoprofile directories, sorted.
+        :rtype: list
+    """
+
+    profiles = set()
+    for path in paths:
+        for candidate in [ProfilePaths.for_kanoprofile_dir(path),
+                          ProfilePaths(os.path.abspath(path))]:
+            if os.path.isdir(candidate.apps_dir) or \
+                    os.path.isfile(candidate.app_state_db):
+                profiles.add(candidate.kanoprofile_dir)
+                break
+        else:
+            if os.path.isdir(path):
+                sub_paths = [os.path.join(path, d) for d in os.listdir(path)]
+                profiles.update(find_profiles(
+                    [p for p in sub_paths if os.path.isdir(p)]))
+    return sorted(profiles)
+
+
+def find_user_profiles():
+    """ Finds the profiles of the local users, the ones with a home under
+        /home.
+
+        Reading them takes root, which is safe as long as they are only
+        loaded with load_exported_states(): nothing in them is written or
+        has its ownership changed.
+
+        :returns: The .kanoprofile directories, sorted.
+        :rtype: list
+    """
+
+    profiles = []
+    for user in pwd.getpwall():
+        if not user.pw_dir.startswith('/home/'):
+            continue
+
+        paths = ProfilePaths(user.pw_dir)
+        if os.path.isdir(paths.kanoprofile_dir):
+            profiles.append(paths.kanoprofile_dir)
+    return sorted(set(profiles))
+
+
+def summarize_tracker(states):
+    """ Sums up the app usage recorded by kano-tracker in a profile.
+
+        :param states: All the app states of the profile.
+        :type states: dict
+
+        :returns: The total runtime in seconds under 'runtime', the number
+            of app starts under 'starts' and the app used for the longest
+            under 'top_app'.
+        :rtype: dict
+    """
+
+    app_stats = (states.get('kano-tracker') or dict()).get('app_stats')
+    if not isinstance(app_stats, dict):
+        app_stats = dict()
+
+    runtimes = dict()
+    starts = 0
+    for app, stats in app_stats.iteritems():
+        if not isinstance(stats, dict):
+            continue
+        runtimes[app] = _to_number(stats.get('runtime', 0))
+        starts += int(_to_number(stats.get('starts', 0)))
+
+    return {
+        'runtime': int(sum(runtimes.itervalues())),
+        'starts': starts,
+        'top_app': max(runtimes, key=runtimes.get) if runtimes else ''
+    }
+
+
+def load_exported_states(profile_dir):
+    """ Loads the states of all the apps in an exported .kanoprofile tree,
+        without writing anything into it.
+
+        :param profile_dir: The .kanoprofile directory.
+        :type profile_dir: str
+
+        :returns: States indexed by the app name.
+        :rtype: dict
+    """
+
+    paths = ProfilePaths.for_kanoprofile_dir(profile_dir)
+
+    if os.path.isfile(paths.app_state_db) and sqlite3 is not None:
+        store = SqliteStore(paths.apps_dir, paths.app_state_db,
+                            read_only=True)
+    else:
+        store = JsonTreeStore(paths.apps_dir, read_only=True)
+
+    try:
+        return store.load_all()
+    finally:
+        store.close()
+
+
+def _load_exported_states_safe(profile_dir):
+    try:
+        return load_exported_states(profile_dir)
+    except Exception as e:
+        logger.error('Unable to load {}: {}'.format(profile_dir, e))
+        return dict()
+
+
+def _to_number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+class _Columns(object):
+    """ The values of the variables of many profiles, one column per
+        (app, variable), with a mask of where the variable is set. Values
+        that aren't numbers are treated as if they weren't set.
+    """
+
+    def __init__(self, all_states):
+        self._all_states = all_states
+        self._columns = {}
+
+    def get(self, app, variable):
+        key = (app, variable)
+        if key not in self._columns:
+            values = numpy.array([_to_number(states[app][variable])
+                                  if app in states and variable in states[app]
+                                  else float('nan')
+                                  for states in self._all_states],
+                                 dtype=float)
+            present = ~numpy.isnan(values)
+            self._columns[key] = (numpy.where(present, values, 0), present)
+        return self._columns[key]
+
+    def set(self, app, variable, values):
+        self._columns[(app, variable)] = (
+            numpy.asarray(values, dtype=float),
+            numpy.ones(len(self._all_states), dtype=bool))
+
+
+def _vector_xp(rules, columns, count):
+    points = numpy.zeros(count)
+
+    for app, groups in (rules['xp'] or dict()).iteritems():
+        for group, group_rules in groups.iteritems():
+            # calculating points based on level
+            if group == 'level':
+                levels, present = columns.get(app, 'level')
+                maxlevel = numpy.trunc(levels)
+
+                thresholds = sorted((int(level), int(value))
+                                    for level, value in group_rules.iteritems())
+                bounds = numpy.array([level for level, _ in thresholds])
+                cumulative = numpy.cumsum([0] + [v for _, v in thresholds])
+                reached = numpy.searchsorted(bounds, maxlevel, side='right')
+                points += numpy.where(present, cumulative[reached], 0)
+
+            # calculating points based on multipliers
+            if group == 'multipliers':
+                for thing, value in group_rules.iteritems():
+                    values, _ = columns.get(app, thing)
+                    points += float(value) * values
+
+    return numpy.trunc(points).astype(int)
+
+
+def _vector_levels(level_table, xp):
+    table = numpy.array(level_table, dtype=float)
+    index = numpy.maximum(
+        numpy.searchsorted(table, xp, side='right') - 1, 0)
+    level_min = table[index]
+    level_max = numpy.append(table[1:], numpy.inf)[index]
+
+    with numpy.errstate(invalid='ignore'):
+        progress = numpy.maximum((xp - level_min) / (level_max - level_min), 0)
+
+    return index + 1, progress
+
+
+def _vector_badge(rules, badge_rules, columns, count):
+    if badge_rules['operation'] == 'each_greater':
+        achieved = numpy.ones(count, dtype=bool)
+        for app, variable, value in badge_rules['targets']:
+            if variable == 'level' and value == -1:
+                value = rules['app_profiles'][app]['max_level']
+            values, present = columns.get(app, variable)
+            achieved &= present & (values >= value)
+        return achieved
+
+    if badge_rules['operation'] == 'sum_greater':
+        total = numpy.zeros(count)
+        for target in badge_rules['targets']:
+            values, present = columns.get(target[0], target[1])
+            total += values
+        return total >= badge_rules['value']
+
+    return None
+
+
+def _evaluate_vectorized(rules, all_states):
+    count = len(all_states)
+    columns = _Columns(all_states)
+
+    if rules['xp']:
+        xp = _vector_xp(rules, columns, count)
+    else:
+        xp = numpy.repeat(-1, count)
+
+    if rules['level_table']:
+        levels, progress = _vector_levels(rules['level_table'], xp)
+    else:
+        levels, progress = numpy.repeat(-1, count), numpy.zeros(count)
+    columns.set('computed', 'kano_level', levels)
+
+    badges = {}
+
+    def do_calculate(select_push_back):
+        for category, subcats in (rules['badges'] or dict()).iteritems():
+            for subcat, items in subcats.iteritems():
+                for item, badge_rules in items.iteritems():
+                    if is_pushed_back(badge_rules) != select_push_back:
+                        continue
+
+                    achieved = _vector_badge(rules, badge_rules, columns,
+                                             count)
+                    if achieved is not None:
+                        badges[(category, subcat, item)] = achieved
+
+    # normal ones
+    do_calculate(False)
+
+    # count offline badges
+    num_offline_badges = numpy.zeros(count, dtype=int)
+    for (category, subcat, _), achieved in badges.iteritems():
+        if is_offline_badge(category, subcat):
+            num_offline_badges += achieved
+    columns.set('computed', 'num_offline_badges', num_offline_badges)
+
+    # add pushed back ones
+    do_calculate(True)
+
+    results = []
+    for i in xrange(count):
+        results.append({
+            'xp': int(xp[i]),
+            'level': int(levels[i]),
+            'progress': float(progress[i]),
+            'unlocked': sorted(key for key, achieved in badges.iteritems()
+                               if achieved[i])
+        })
+    return results
+
+
+class _NoQuests(object):
+    """ Stands in for the quests of the user running the report. """
+
+    def evaluate_xp(self):
+        return 0
+
+    def evaluate_badges(self):
+        return dict()
+
+
+def _evaluate_snapshots(rules, all_states):
+    # Imported here, it pulls in the whole profile machinery
+    from .badges import ProfileSnapshot
+
+    results = []
+    for states in all_states:
+        snapshot = ProfileSnapshot(states)
+        snapshot.rules = rules
+        snapshot.quests = _NoQuests()
+        try:
+            level, progress, _ = snapshot.level
+            unlocked = sorted((category, subcat, item)
+                              for category, subcats in snapshot.badges.iteritems()
+                              for subcat, items in subcats.iteritems()
+                              if (category, subcat) != ('badges', 'quests')
+                              for item, badge in items.iteritems()
+                              if badge['achieved'])
+        except Exception as e:
+            # Values of the wrong type, as the vectorised evaluator we
+            # don't let one broken profile spoil the whole report
+            logger.error('Unable to evaluate a profile: {}'.format(e))
+            results.append({'xp': -1, 'level': -1, 'progress': 0,
+                            'unlocked': []})
+            continue
+
+        results.append({
+            'xp': snapshot.xp,
+            'level': level,
+            'progress': progress,
+            'unlocked': unlocked
+        })
+    return results
+
+
+def evaluate_profiles(profile_dirs, use_numpy=True, processes=1):
+    """ Computes the XP, level and badges of many exported profiles.
+
+        :param profile_dirs: The .kanoprofile directories.
+        :type profile_dirs: list
+
+        :param use_numpy: Use the vectorised evaluator if NumPy is
+            available.
+        :type use_numpy: Boolean
+
+        :param processes: Number of processes loading the profiles, the
+            loading being what takes most of the time.
+        :type processes: int
+
+        :returns: A summary per profile, in the same order, with the keys
+            of SUMMARY_FIELDS and the unlocked badges and environments as
+            'category/subcategory/item' under 'unlocked'. The runtime,
+            starts and top_app fields are from summarize_tracker().
+        :rtype: list
+    """
+
+    rules = load_rules(read_only=True)
+
+    if processes > 1 and len(profile_dirs) > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            all_states = pool.map(_load_exported_states_safe, profile_dirs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        all_states = map(_load_exported_states_safe, profile_dirs)
+
+    if use_numpy and numpy is not None:
+        results = _evaluate_vectorized(rules, all_states)
+    else:
+        results = _evaluate_snapshots(rules, all_states)
+
+    summaries = []
+    for profile_dir, states, result in zip(profile_dirs, all_states, results):
+        unlocked = ['/'.join(key) for key in result['unlocked']]
+        summary = summarize_tracker(states)
+        summary.update({
+            'profile': profile_dir,
+            'xp': result['xp'],
+            'level': result['level'],
+            'progress': result['progress'],
+            'badges': sum(1 for key in result['unlocked']
+                          if key[0] == 'badges'),
+            'environments': sum(1 for key in result['unlocked']
+                                if key[0] == 'environments'),
+            'unlocked': unlocked
+        })
+        summaries.append(summary)
+    return summaries
+
+
+def write_summaries(summaries, out, output_format='csv'):
+    """ Writes the summaries as CSV (without the list of unlocked items)
+        or JSON.
+
+        :param out: Where to write.
+        :type out: file
+    """
+
+    if output_format == 'json':
+        json.dump(summaries, out, indent=2, sort_keys=True)
+        out.write('\n')
+        return
+
+    writer = csv.DictWriter(out, SUMMARY_FIELDS, extrasaction='ignore')
+    writer.writeheader()
+    for summary in summaries:
+        writer.writerow(summary)
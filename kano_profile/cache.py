@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+# cache.py
+#
+# Copyright (C) 2015 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+
+"""
+Process-local caches of parsed profile files
+
+An entry is reused for as long as the files it was loaded from keep the
+same mtime, size and inode. Writers in this process invalidate the entries
+explicitly, changes made by other processes are picked up through the stat
+signature.
+"""
+
+import os
+import time
+import copy
+
+# Timestamps of files are only updated once per kernel tick, so a file
+# changed again within this many seconds of being loaded could keep the
+# same signature. Such entries are not trusted.
+RACY_WINDOW = 0.05
+
+
+def get_signature(paths):
+    """ Returns a tuple identifying the current version of the files.
+
+        :param paths: The files to look at, they don't need to exist.
+        :type paths: list
+
+        :returns: (mtime, size, inode) for each file, None if it's missing.
+        :rtype: tuple
+    """
+
+    signature = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            signature.append(None)
+        else:
+            signature.append((st.st_mtime, st.st_size, st.st_ino))
+    return tuple(signature)
+
+
+def is_racy(signature, loaded_at):
+    """ Whether a file could still change without its signature changing.
+
+        :param signature: As returned by get_signature().
+        :type signature: tuple
+
+        :param loaded_at: When the files were read.
+        :type loaded_at: float
+    """
+
+    for entry in signature:
+        if entry is not None and loaded_at - entry[0] < RACY_WINDOW:
+            return True
+    return False
+
+
+class FileCache(object):
+    """ Memoizes the result of loading a set of files.
+
+        Callers get a deep copy of the cached value, so they are free to
+        modify it.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+
+        # Bumped on every invalidation, lets dependent caches notice
+        # changes made by this process that aren't on the disk yet
+        self.generation = 0
+
+    def get(self, key, paths, loader):
+        """ Returns the cached value or loads it again if the files changed.
+
+            :param key: Identifies the entry.
+            :type key: hashable
+
+            :param paths: The files the value is loaded from.
+            :type paths: list
+
+            :param loader: Called without arguments to load the value.
+            :type loader: function
+        """
+
+        signature = get_signature(paths)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == signature:
+            self.hits += 1
+            return copy.deepcopy(entry[1])
+
+        self.misses += 1
+        loaded_at = time.time()
+        value = loader()
+
+        if is_racy(signature, loaded_at):
+            self._entries.pop(key, None)
+        else:
+            self._entries[key] = (signature, value)
+
+        return copy.deepcopy(value)
+
+    def peek(self, key, paths):
+        """ Returns the cached value if it's still valid, without loading
+            it otherwise.
+
+            :returns: The value or None.
+        """
+
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == get_signature(paths):
+            self.hits += 1
+            return copy.deepcopy(entry[1])
+
+    def invalidate(self, key=None):
+        """ Drop an entry or the whole cache if no key is given. """
+
+        self.generation += 1
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+    def get_stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._entries)
+        }
+
+
+app_state_cache = FileCache('app_state')
+app_list_cache = FileCache('app_list')
+profile_cache = FileCache('profile')
+
+
+def get_cache_stats():
+    """ Returns the hit and miss counters of all the caches.
+
+        :returns: Counters indexed by the cache name.
+        :rtype: dict
+    """
+
+    return dict((cache.name, cache.get_stats())
+                for cache in [app_state_cache, app_list_cache,
+                              profile_cache])
@@ -0,0 +1,647 @@
+#!/usr/bin/env python
+
+# event_log.py
+#
+# Copyright (C) 2015 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+
+"""
+Segmented log of the tracker events
+
+The events are appended to numbered segment files in tracker/events.d. A
+new segment is started whenever the tracker token changes, i.e. on every
+boot, and once the current segment grows past SEGMENT_SIZE, so a segment
+only ever holds the events of one boot. manifest.json lists the segments
+in order along with their tokens.
+
+Old events are dropped by deleting whole segments instead of rewriting the
+log: after an upload, and by the retention policy which caps the total size
+of the log. The single events file used before is moved into segments the
+first time the log is opened.
+
+Uploads are acknowledged with a cursor: the manifest records how far into
+each segment the events were acknowledged and reading resumes from there.
+The position of an event also makes up its sequence number, which stays
+the same when the event is read again.
+
+The fields all the events of a boot share (token, OS version, CPU id and
+timezone) are stored once, in a header on the first line of a segment. The
+events themselves are stored as short JSON arrays of their type, the time
+relative to the header, the name and the payload, and are expanded back to
+full events when read. Events that don't fit the header, as well as those
+written by older versions, are stored as full JSON objects.
+"""
+
+import os
+import json
+import threading
+
+from kano.logging import logger
+from kano.utils import read_json, ensure_dir
+from .storage import AppStateLock
+from .atomic import write_file_atomic, write_json_atomic
+from .ownership import fix_ownership
+
+MANIFEST_VERSION = 1
+MANIFEST_FILE = 'manifest.json'
+LOCK_FILE = 'manifest.lock'
+
+# Start a new segment once the current one is this big
+SEGMENT_SIZE = 256 * 1024
+
+# The oldest segments are dropped while the log is bigger than this
+MAX_LOG_SIZE = 2 * 1024 * 1024
+
+# The sequence number of an event is the id of its segment shifted by this
+# many bits plus its offset in the segment
+SEQUENCE_SHIFT = 32
+
+HEADER_FORMAT = 1
+
+# The fields stored in the header rather than in every event
+SHARED_FIELDS = ['token', 'os_version', 'cpu_id']
+
+# The code of each type of event in the compact format and the field
+# holding its payload
+EVENT_TYPES = {
+    'action': ('a', None),
+    'data': ('d', 'data'),
+    'session': ('s', 'length')
+}
+_EVENT_CODES = dict((code, (event_type, payload))
+                    for event_type, (code, payload) in EVENT_TYPES.iteritems())
+
+
+class EventLog(object):
+    """ An append-only log of event lines split into segments.
+
+        The manifest is only modified with the lock held, the segments are
+        only appended to with the lock held. Readers get a list of the
+        segments and can read them without the lock, the last line of a
+        segment being written might be incomplete and is skipped.
+    """
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE,
+                 max_size=MAX_LOG_SIZE, legacy_file=None):
+        """
+            :param directory: Where the segments and the manifest are.
+            :type directory: str
+
+            :param segment_size: Size in bytes after which a new segment is
+                started.
+            :type segment_size: int
+
+            :param max_size: The retention limit, see apply_retention().
+            :type max_size: int
+
+            :param legacy_file: A single-file event log to move into the
+                segments.
+            :type legacy_file: str
+        """
+
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.legacy_file = legacy_file
+
+        self.manifest_file = os.path.join(directory, MANIFEST_FILE)
+        self._thread_lock = threading.RLock()
+
+    def lock(self):
+        """ Returns a lock object guarding the log against other processes.
+
+            Threads of the same process are serialised by the methods of
+            the log itself.
+        """
+
+        return AppStateLock(self.directory, lock_file=LOCK_FILE)
+
+    def get_segment_path(self, segment_id):
+        return os.path.join(self.directory, '{:08d}.log'.format(segment_id))
+
+    def get_segments(self):
+        """ Returns the segments of the log, oldest first.
+
+            :returns: Dicts with the 'id', 'token', 'path' and 'acked'
+                offset of each segment. The token is None for segments of
+                unknown origin.
+            :rtype: list
+        """
+
+        with self._thread_lock, self.lock():
+            manifest = self._load_manifest()
+
+        segments = []
+        for segment in manifest['segments']:
+            segment = dict(segment)
+            segment['path'] = self.get_segment_path(segment['id'])
+            segment.setdefault('acked', 0)
+            segments.append(segment)
+        return segments
+
+    def get_size(self):
+        """ Returns the total size of the segments in bytes. """
+
+        return sum(_get_file_size(segment['path'])
+                   for segment in self.get_segments())
+
+    def append(self, events, token):
+        """ Append events to the log.
+
+            :param events: The events, as sent to the tracker endpoint.
+            :type events: list
+
+            :param token: The tracker token of the events. A new segment is
+                started if it's different from the token of the current one.
+            :type token: str
+        """
+
+        if not events:
+            return
+
+        with self._thread_lock, self.lock():
+            manifest = self._load_manifest()
+            segments = manifest['segments']
+
+            lines = []
+            if not segments or segments[-1]['token'] != token or \
+                    _get_file_size(self.get_segment_path(
+                        segments[-1]['id'])) >= self.segment_size:
+                self._add_segment(manifest, token)
+                self._apply_retention(manifest)
+                self._write_manifest(manifest)
+
+                header = make_header(events[0], token)
+                lines.append(encode_header(header))
+            else:
+                # Not cached, another process may have rewritten the
+                # segment with a different header, see rewrite()
+                header = read_header(self.get_segment_path(
+                    segments[-1]['id']))[0]
+
+            path = self.get_segment_path(segments[-1]['id'])
+
+            lines += [encode_event(header, event) for event in events]
+            _append(path, ''.join(lines))
+            fix_ownership(path)
+
+    def drop_segments(self, keep=None):
+        """ Delete whole segments.
+
+            :param keep: Called with each segment (as get_segments()), the
+                segment is deleted unless it returns True. All the segments
+                are deleted by default.
+            :type keep: function
+
+            :returns: The number of segments deleted.
+            :rtype: int
+        """
+
+        with self._thread_lock, self.lock():
+            manifest = self._load_manifest()
+
+            kept = []
+            dropped = []
+            for segment in manifest['segments']:
+                path = self.get_segment_path(segment['id'])
+                if keep is not None and \
+                        keep(dict(segment, path=path)):
+                    kept.append(segment)
+                else:
+                    dropped.append(segment)
+
+            if dropped:
+                manifest['segments'] = kept
+                self._write_manifest(manifest)
+                for segment in dropped:
+                    _remove(self.get_segment_path(segment['id']))
+
+        return len(dropped)
+
+    def acknowledge(self, positions):
+        """ Move the cursors of the segments forward.
+
+            Segments acknowledged up to their end are deleted, unless they
+            are the current one, which could still grow.
+
+            :param positions: Offsets up to which the events were handled,
+                indexed by the segment id.
+            :type positions: dict
+
+            :returns: The number of segments deleted.
+            :rtype: int
+        """
+
+        if not positions:
+            return 0
+
+        with self._thread_lock, self.lock():
+            manifest = self._load_manifest()
+            segments = manifest['segments']
+
+            kept = []
+            dropped = []
+            moved = False
+            for i, segment in enumerate(segments):
+                acked = segment.get('acked', 0)
+                if positions.get(segment['id'], 0) > acked:
+                    acked = segment['acked'] = positions[segment['id']]
+                    moved = True
+
+                path = self.get_segment_path(segment['id'])
+                if i < len(segments) - 1 and \
+                        segment['id'] in positions and \
+                        acked >= _get_file_size(path):
+                    dropped.append(segment)
+                else:
+                    kept.append(segment)
+
+            if not moved and not dropped:
+                return 0
+
+            manifest['segments'] = kept
+            self._write_manifest(manifest)
+            for segment in dropped:
+                _remove(self.get_segment_path(segment['id']))
+
+        return len(dropped)
+
+    def clear(self, keep_token=None):
+        """ Delete the segments of all the tokens but one.
+
+            :param keep_token: Keep the segments of this token.
+            :type keep_token: str
+        """
+
+        return self.drop_segments(
+            lambda segment: keep_token is not None and
+            segment['token'] == keep_token)
+
+    def rewrite(self, token, transform):
+        """ Replace the events in the segments of a token.
+
+            The segments of other tokens aren't touched, so this is only as
+            expensive as the number of events of that token.
+
+            :param token: The token whose events to rewrite.
+            :type token: str
+
+            :param transform: Called with each event, returns the new event.
+            :type transform: function
+        """
+
+        with self._thread_lock, self.lock():
+            manifest = self._load_manifest()
+            for segment in manifest['segments']:
+                if segment['token'] != token:
+                    continue
+
+                path = self.get_segment_path(segment['id'])
+                events = [transform(event)
+                          for _, _, event in iter_events(path)
+                          if event is not None]
+                write_file_atomic(path, encode_segment(events, token))
+                fix_ownership(path)
+
+    def apply_retention(self, max_size=None):
+        """ Delete the oldest segments while the log is bigger than the
+            limit. The current segment is always kept.
+
+            :param max_size: The limit in bytes, defaults to the one of the
+                log.
+            :type max_size: int
+
+            :returns: The number of segments deleted.
+            :rtype: int
+        """
+
+        with self._thread_lock, self.lock():
+            manifest = self._load_manifest()
+            dropped = self._apply_retention(manifest, max_size)
+            if dropped:
+                self._write_manifest(manifest)
+        return dropped
+
+    def _apply_retention(self, manifest, max_size=None):
+        if max_size is None:
+            max_size = self.max_size
+
+        segments = manifest['segments']
+        sizes = [_get_file_size(self.get_segment_path(segment['id']))
+                 for segment in segments]
+        total = sum(sizes)
+
+        dropped = 0
+        while total > max_size and len(segments) > 1:
+            segment = segments.pop(0)
+            total -= sizes.pop(0)
+            logger.info('Dropping tracker events segment {}'.format(
+                segment['id']))
+            _remove(self.get_segment_path(segment['id']))
+            dropped += 1
+        return dropped
+
+    def _add_segment(self, manifest, token):
+        segment = {
+            'id': manifest['next_id'],
+            'token': token
+        }
+        manifest['next_id'] += 1
+        manifest['segments'].append(segment)
+        return segment
+
+    def _load_manifest(self):
+        """ Reads the manifest, the lock must be held. """
+
+        manifest = None
+        if os.path.exists(self.manifest_file):
+            manifest = read_json(self.manifest_file)
+            if not manifest or \
+                    manifest.get('version') != MANIFEST_VERSION:
+                logger.warn('Tracker events manifest corrupted, rebuilding')
+                manifest = None
+
+        if manifest is None:
+            manifest = self._rebuild_manifest()
+
+        if self.legacy_file and os.path.exists(self.legacy_file):
+            self._import_legacy_file(manifest)
+
+        return manifest
+
+    def _rebuild_manifest(self):
+        """ Creates a manifest from the segments found on the disk. """
+
+        manifest = {
+            'version': MANIFEST_VERSION,
+            'next_id': 1,
+            'segments': []
+        }
+
+        ensure_dir(self.directory)
+        fix_ownership(self.directory)
+
+        ids = []
+        for name in os.listdir(self.directory):
+            base, ext = os.path.splitext(name)
+            if ext == '.log' and base.isdigit():
+                ids.append(int(base))
+
+        for segment_id in sorted(ids):
+            manifest['segments'].append({'id': segment_id, 'token': None})
+            manifest['next_id'] = segment_id + 1
+
+        self._write_manifest(manifest)
+        return manifest
+
+    def _import_legacy_file(self, manifest):
+        """ Moves the events from the old single file into segments, one
+            per token.
+        """
+
+        logger.info('Moving tracker events from {}'.format(self.legacy_file))
+
+        by_token = {}
+        tokens = []
+        for line in iter_lines(self.legacy_file):
+            try:
+                event = json.loads(line)
+                token = event.get('token')
+            except Exception:
+                logger.warn("Found a corrupted event, skipping.")
+                continue
+
+            if token not in by_token:
+                by_token[token] = []
+                tokens.append(token)
+            by_token[token].append(event)
+
+        for token in tokens:
+            segment = self._add_segment(manifest, token)
+            path = self.get_segment_path(segment['id'])
+            write_file_atomic(path, encode_segment(by_token[token], token))
+            fix_ownership(path)
+
+        self._write_manifest(manifest)
+        _remove(self.legacy_file)
+
+    def _write_manifest(self, manifest):
+        write_json_atomic(self.manifest_file, manifest)
+        fix_ownership(self.manifest_file)
+
+
+def iter_lines(path):
+    """ Yields the complete lines of a segment one by one, a line still
+        being written is left out.
+
+        :returns: The lines, each ending with a newline.
+        :rtype: generator
+    """
+
+    for _, line in iter_positioned_lines(path):
+        yield line
+
+
+def iter_positioned_lines(path, offset=0):
+    """ Like iter_lines(), starting at an offset.
+
+        :returns: (offset, line) pairs, the offset being where the line
+            starts in the file.
+        :rtype: generator
+    """
+
+    try:
+        f = open(path)
+    except IOError:
+        return
+
+    with f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith('\n'):
+                break
+            yield offset, line
+            offset += len(line)
+
+
+def iter_events(path, offset=0):
+    """ Yields the events of a segment, expanded to full events.
+
+        :param offset: Where to start, the header is read in any case.
+        :type offset: int
+
+        :returns: (offset, end, event) triples, the event is None if its
+            line is corrupted.
+        :rtype: generator
+    """
+
+    header, start = read_header(path)
+    for line_offset, line in iter_positioned_lines(path, max(offset, start)):
+        try:
+            event = decode_event(header, line)
+        except Exception:
+            event = None
+        yield line_offset, line_offset + len(line), event
+
+
+def make_header(event, token):
+    """ Returns the header for a segment starting with an event. """
+
+    header = {
+        'format': HEADER_FORMAT,
+        'token': token,
+        'time': event.get('time'),
+        'timezone_offset': event.get('timezone_offset')
+    }
+    for field in SHARED_FIELDS[1:]:
+        header[field] = event.get(field)
+    return header
+
+
+def encode_header(header):
+    return json.dumps(header, sort_keys=True) + '\n'
+
+
+def read_header(path):
+    """ Reads the header of a segment.
+
+        :returns: The header and the offset the events start at, (None, 0)
+            if the segment has no header.
+        :rtype: tuple
+    """
+
+    try:
+        with open(path) as f:
+            line = f.readline()
+    except IOError:
+        return None, 0
+
+    if not line.endswith('\n') or not line.startswith('{'):
+        return None, 0
+
+    try:
+        header = json.loads(line)
+    except ValueError:
+        return None, 0
+
+    if header.get('format') != HEADER_FORMAT or 'type' in header:
+        return None, 0
+
+    return header, len(line)
+
+
+def encode_event(header, event):
+    """ Serialises an event as a line of a segment.
+
+        :param header: The header of the segment, None if it has none.
+        :type header: dict
+
+        :returns: The line, compact if the event fits the header.
+        :rtype: str
+    """
+
+    if header is None or event.get('type') not in EVENT_TYPES:
+        return json.dumps(event) + '\n'
+
+    code, payload = EVENT_TYPES[event['type']]
+    fields = set(SHARED_FIELDS + ['type', 'time', 'timezone_offset', 'name'])
+    if payload is not None:
+        fields.add(payload)
+
+    if set(event) != fields or \
+            any(event[field] != header[field] for field in SHARED_FIELDS) or \
+            type(event['time']) != int or type(header['time']) != int:
+        return json.dumps(event) + '\n'
+
+    values = [code, event['time'] - header['time'], event['name']]
+    if payload is not None:
+        values.append(event[payload])
+
+    if event['timezone_offset'] != header['timezone_offset']:
+        if payload is None:
+            values.append(None)
+        values.append(event['timezone_offset'])
+
+    return json.dumps(values, separators=(',', ':')) + '\n'
+
+
+def decode_event(header, line):
+    """ Expands a line of a segment to the full event.
+
+        :raises ValueError: The line is corrupted.
+    """
+
+    values = json.loads(line)
+    if isinstance(values, dict):
+        return values
+
+    if header is None or not isinstance(values, list) or len(values) < 3 or \
+            values[0] not in _EVENT_CODES:
+        raise ValueError('Not an event: {}'.format(line))
+
+    event_type, payload = _EVENT_CODES[values[0]]
+    event = {
+        'type': event_type,
+        'time': header['time'] + values[1],
+        'timezone_offset': header['timezone_offset'],
+        'name': values[2]
+    }
+    for field in SHARED_FIELDS:
+        event[field] = header[field]
+
+    if payload is not None and len(values) > 3:
+        event[payload] = values[3]
+    if len(values) > 4:
+        event['timezone_offset'] = values[4]
+
+    return event
+
+
+def encode_segment(events, token):
+    """ Serialises a whole segment, with its header.
+
+        :rtype: str
+    """
+
+    if not events:
+        return ''
+
+    header = make_header(events[0], token)
+    return encode_header(header) + \
+        ''.join(encode_event(header, event) for event in events)
+
+
+def get_sequence_number(segment_id, offset):
+    """ Returns the sequence number of the event at an offset of a segment.
+
+        The numbers grow with every event appended to the log.
+
+        :rtype: int
+    """
+
+    return (segment_id << SEQUENCE_SHIFT) + offset
+
+
+def _append(path, data):
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+        while data:
+            written = os.write(fd, data)
+            data = data[written:]
+    finally:
+        os.close(fd)
+
+
+def _get_file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        logger.error('Unable to remove {}: {}'.format(path, e))
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+# ownership.py
+#
+# Copyright (C) 2015 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+
+"""
+Keeping the files in the profile owned by the user when running under sudo
+
+Privileged tools (kano-sync, kano-tracker-ctl, ...) write into the user's
+profile as root. Instead of blindly calling chown on every path after each
+write, the ownership is checked first and only fixed when it's wrong.
+Directories that have been verified are remembered for the lifetime of the
+process. Files aren't, as they are often replaced by a rename.
+"""
+
+import os
+import pwd
+import grp
+import stat
+
+from kano.logging import logger
+from kano.utils import get_user_unsudoed
+
+_owner_ids = None
+_verified_dirs = set()
+
+
+def _get_owner_ids():
+    global _owner_ids
+
+    if _owner_ids is None:
+        user = get_user_unsudoed()
+        try:
+            _owner_ids = (pwd.getpwnam(user).pw_uid, grp.getgrnam(user).gr_gid)
+        except KeyError as e:
+            logger.error('Unable to look up the owner {}: {}'.format(user, e))
+            _owner_ids = False
+
+    return _owner_ids
+
+
+def fix_ownership(*paths):
+    """ Make sure the paths are owned by the user who ran sudo.
+
+        Does nothing unless running under sudo. Paths that don't exist are
+        skipped.
+
+        :param paths: Files or directories to check.
+        :type paths: str
+    """
+
+    if 'SUDO_USER' not in os.environ:
+        return
+
+    owner_ids = _get_owner_ids()
+    if not owner_ids:
+        return
+
+    for path in paths:
+        if path in _verified_dirs:
+            continue
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+
+        if (st.st_uid, st.st_gid) != owner_ids:
+            try:
+                os.chown(path, *owner_ids)
+            except OSError as e:
+                logger.error('Unable to chown {}: {}'.format(path, e))
+                continue
+
+        if stat.S_ISDIR(st.st_mode):
+            _verified_dirs.add(path)
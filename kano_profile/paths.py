@@ -11,8 +11,13 @@ import os
 from kano.logging import logger
 from kano.utils import get_user_unsudoed, get_home_by_username
 
+# Point the profile and the rules elsewhere, e.g. for benchmarks
+HOME_ENV_VAR = 'KANO_PROFILE_HOME'
+RULES_ENV_VAR = 'KANO_PROFILE_RULES'
+
 linux_user = get_user_unsudoed()
-home_directory = get_home_by_username(linux_user)
+home_directory = os.environ.get(HOME_ENV_VAR) or \
+    get_home_by_username(linux_user)
 
 # setting up directories
 dir_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
@@ -20,7 +25,9 @@ dir_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 # rules path
 rules_local = os.path.join(dir_path, 'rules')
 rules_usr = '/usr/share/kano-profile/rules/'
-if os.path.exists(rules_local):
+if os.environ.get(RULES_ENV_VAR):
+    rules_dir = os.environ[RULES_ENV_VAR]
+elif os.path.exists(rules_local):
     rules_dir = rules_local
 elif os.path.exists(rules_usr):
     rules_dir = rules_usr
@@ -50,25 +57,86 @@ else:
 
 # constructing paths of directories, files
 kanoprofile_dir_str = '.kanoprofile'
-kanoprofile_dir = os.path.join(home_directory, kanoprofile_dir_str)
-
 profile_dir_str = 'profile'
-profile_dir = os.path.join(kanoprofile_dir, profile_dir_str)
-
 apps_dir_str = 'apps'
-apps_dir = os.path.join(kanoprofile_dir, apps_dir_str)
+app_state_db_str = 'apps.db'
+profile_file_str = 'profile.json'
 
-online_badges_dir = os.path.join(profile_dir, "badges")
-online_badges_file = os.path.join(online_badges_dir, "badges.json")
 
-profile_file_str = 'profile.json'
-profile_file = os.path.join(profile_dir, profile_file_str)
+class ProfilePaths(object):
+    """ The locations of the files in the Kano profile of a user.
+
+        The paths at the module level belong to the user running the
+        program (the one who ran sudo). Use this to work with the profile
+        in any other home directory.
+    """
+
+    def __init__(self, home_directory, kanoprofile_dir=None):
+        """
+            :param home_directory: The home of the user.
+            :type home_directory: str
+
+            :param kanoprofile_dir: Where the profile is, if it isn't the
+                .kanoprofile directory in the home, e.g. for a copy.
+            :type kanoprofile_dir: str
+        """
+
+        if kanoprofile_dir is None:
+            kanoprofile_dir = os.path.join(home_directory, kanoprofile_dir_str)
+
+        self.home_directory = home_directory
+        self.kanoprofile_dir = kanoprofile_dir
+
+        self.profile_dir = os.path.join(kanoprofile_dir, profile_dir_str)
+        self.apps_dir = os.path.join(kanoprofile_dir, apps_dir_str)
+        self.app_index_file = os.path.join(kanoprofile_dir, 'apps.index.json')
+        self.app_state_db = os.path.join(kanoprofile_dir, app_state_db_str)
+        self.stats_index_file = os.path.join(kanoprofile_dir,
+                                             'stats_index.json')
+        self.rules_bundle_file = os.path.join(kanoprofile_dir, 'rules.cache')
+
+        self.online_badges_dir = os.path.join(self.profile_dir, "badges")
+        self.online_badges_file = os.path.join(self.online_badges_dir,
+                                               "badges.json")
+        self.profile_file = os.path.join(self.profile_dir, profile_file_str)
+
+        self.tracker_dir = os.path.join(kanoprofile_dir, 'tracker/sessions/')
+        self.tracker_events_file = os.path.join(kanoprofile_dir,
+                                                'tracker/events')
+        self.tracker_events_dir = os.path.join(kanoprofile_dir,
+                                               'tracker/events.d')
+        self.tracker_token_file = os.path.join(kanoprofile_dir,
+                                               'tracker/token')
+
+    @classmethod
+    def for_user(cls, username):
+        return cls(get_home_by_username(username))
+
+    @classmethod
+    def for_kanoprofile_dir(cls, path):
+        path = os.path.abspath(path)
+        return cls(os.path.dirname(path), path)
+
+
+current_paths = ProfilePaths(home_directory)
+
+kanoprofile_dir = current_paths.kanoprofile_dir
+profile_dir = current_paths.profile_dir
+apps_dir = current_paths.apps_dir
+app_index_file = current_paths.app_index_file
+app_state_db = current_paths.app_state_db
+stats_index_file = current_paths.stats_index_file
+rules_bundle_file = current_paths.rules_bundle_file
+online_badges_dir = current_paths.online_badges_dir
+online_badges_file = current_paths.online_badges_file
+profile_file = current_paths.profile_file
 
 xp_file = os.path.join(rules_dir, 'xp.json')
 levels_file = os.path.join(rules_dir, 'levels.json')
 
 app_profiles_file = os.path.join(rules_dir, 'app_profiles.json')
 
-tracker_dir = os.path.join(kanoprofile_dir, 'tracker/sessions/')
-tracker_events_file = os.path.join(kanoprofile_dir, 'tracker/events')
-tracker_token_file = os.path.join(kanoprofile_dir, 'tracker/token')
+tracker_dir = current_paths.tracker_dir
+tracker_events_file = current_paths.tracker_events_file
+tracker_events_dir = current_paths.tracker_events_dir
+tracker_token_file = current_paths.tracker_token_file
@@ -9,10 +9,13 @@
 import os
 
 from kano.logging import logger
-from kano.utils import (read_json, write_json, get_date_now, ensure_dir,
-                        chown_path, get_user_unsudoed, run_bg, is_running,
+from kano.utils import (read_json, get_date_now, ensure_dir,
+                        get_user_unsudoed, run_bg, is_running,
                         list_dir)
 from .paths import profile_file, profile_dir, kanoprofile_dir, bin_dir
+from .cache import profile_cache
+from .atomic import write_json_atomic
+from .ownership import fix_ownership
 from kano_avatar.paths import AVATAR_DEFAULT_LOC
 
 
@@ -22,7 +25,8 @@ def load_profile():
     :returns: profile data as a dict
     :rtype: dict
     '''
-    data = read_json(profile_file)
+    data = profile_cache.get(profile_file, [profile_file],
+                             lambda: read_json(profile_file))
     if not data:
         data = dict()
         # if the profile file doesn't exist make sure that the new one
@@ -45,12 +49,10 @@ def save_profile(data):
     data.pop('mac_addr', None)
     data['save_date'] = get_date_now()
     ensure_dir(profile_dir)
-    write_json(profile_file, data)
+    write_json_atomic(profile_file, data)
+    profile_cache.invalidate(profile_file)
 
-    if 'SUDO_USER' in os.environ:
-        chown_path(kanoprofile_dir)
-        chown_path(profile_dir)
-        chown_path(profile_file)
+    fix_ownership(kanoprofile_dir, profile_dir, profile_file)
 
     if os.path.exists('/usr/bin/kdesk') and not is_running('kano-sync'):
         logger.info('refreshing kdesk from save_profile')
@@ -11,6 +11,8 @@ import imp
 from kano.logging import logger
 from kano.utils import ensure_dir, run_cmd
 from .paths import profile_dir
+from .atomic import write_file_atomic
+from .ownership import fix_ownership
 from kano_profile_gui.paths import media_dir
 from kano.notifications import display_generic_notification
 
@@ -414,8 +416,8 @@ class Quest(object):
             store[self._id] = {}
         store[self._id]['state'] = self._state
 
-        with open(QUESTS_STORE, 'w') as quest_store_f:
-            json.dump(store, quest_store_f)
+        write_file_atomic(QUESTS_STORE, json.dumps(store))
+        fix_ownership(QUESTS_STORE)
 
     def _can_be_active(self):
         active = True
@@ -0,0 +1,496 @@
+#!/usr/bin/env python
+
+# rules.py
+#
+# Copyright (C) 2015 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+
+"""
+Compiled bundle of all the rule files
+
+xp.json, levels.json, app_profiles.json and the badge and environment
+rules are merged, checked and saved as JSON into a single file in the
+profile.
+The bundle is compiled again whenever any of the source files changes, so
+the rules are normally loaded with one read instead of parsing every
+file. Within a process the loaded bundle is shared, don't modify it.
+
+The bundle is plain data and is also loaded by tools running as root, so
+it's never unpickled or evaluated.
+"""
+
+import os
+import time
+import json
+import bisect
+
+from kano.logging import logger
+from kano.utils import read_json, ensure_dir
+from .paths import rules_dir, xp_file, levels_file, app_profiles_file, \
+    rules_bundle_file
+from .cache import get_signature, is_racy
+from .atomic import write_file_atomic
+from .ownership import fix_ownership
+
+# Bump when the layout of the bundle changes
+RULES_BUNDLE_VERSION = 3
+
+BADGE_RULE_FOLDERS = ['badges', 'environments']
+OPERATIONS = ['each_greater', 'sum_greater']
+
+_bundle = None
+
+
+def get_rule_sources():
+    """ Returns the paths of all the files the rules are compiled from,
+        including the badge rule folders themselves.
+    """
+
+    paths = [xp_file, levels_file, app_profiles_file]
+    for folder in BADGE_RULE_FOLDERS:
+        folder_fullpath = os.path.join(rules_dir, folder)
+        paths.append(folder_fullpath)
+        if os.path.isdir(folder_fullpath):
+            paths += [os.path.join(folder_fullpath, f)
+                      for f in sorted(os.listdir(folder_fullpath))]
+    return paths
+
+
+def read_badge_rules():
+    """ Parses the badge and environment rule files.
+
+        :returns: The rules, indexed by the category (the folder), the
+            subcategory (the file) and the name of the item.
+        :rtype: dict
+    """
+
+    if not os.path.exists(rules_dir):
+        logger.error('rules dir missing')
+        return
+
+    merged_rules = dict()
+    for folder in BADGE_RULE_FOLDERS:
+        folder_fullpath = os.path.join(rules_dir, folder)
+        if not os.path.exists(folder_fullpath):
+            logger.error('rules subfolder missing: {}'.format(folder_fullpath))
+            return
+
+        rule_files = os.listdir(folder_fullpath)
+        if not rule_files:
+            logger.error('no rule files in subfolder: {}'.format(folder_fullpath))
+            return
+
+        for rule_file in rule_files:
+            rule_file_fullpath = os.path.join(folder_fullpath, rule_file)
+            rule_data = read_json(rule_file_fullpath)
+            if not rule_data:
+                logger.error('rule file empty: {}'.format(rule_file_fullpath))
+                continue
+
+            category = folder
+            subcategory = rule_file.split('.')[0]
+
+            merged_rules.setdefault(category, dict())[subcategory] = rule_data
+    return merged_rules
+
+
+def build_badge_dependency_index(all_rules):
+    """ Finds which badge rules read which state variables.
+
+        :param all_rules: As returned by read_badge_rules().
+        :type all_rules: dict
+
+        :returns: (category, subcategory, item) of the rules indexed by
+            the (app, variable) pairs they depend on. The variables of the
+            'computed' app, kano_level and num_offline_badges, are included.
+        :rtype: dict
+    """
+
+    index = dict()
+    if not all_rules:
+        return index
+
+    for category, subcats in all_rules.iteritems():
+        for subcat, items in subcats.iteritems():
+            for item, rules in items.iteritems():
+                for target in rules.get('targets', []):
+                    index.setdefault((target[0], target[1]), set()).add(
+                        (category, subcat, item))
+    return index
+
+
+def build_level_table(level_rules):
+    """ Turns levels.json into the list of the XP each level starts at,
+        level 1 first.
+    """
+
+    if not level_rules:
+        return []
+
+    return [xp for _, xp in sorted((int(level), xp)
+                                   for level, xp in level_rules.iteritems())]
+
+
+def get_level_info(level_table, xp):
+    """ Finds the level the user is at.
+
+        :param level_table: As returned by build_level_table().
+        :type level_table: list
+
+        :param xp: The XP of the user.
+        :type xp: int
+
+        :returns: The level, the progress towards the next level between 0
+            and 1, the XP the level starts at and the XP the next one starts
+            at (infinite at the last level).
+        :rtype: tuple
+    """
+
+    index = max(bisect.bisect_right(level_table, xp) - 1, 0)
+    level_min = level_table[index]
+    if index + 1 < len(level_table):
+        level_max = level_table[index + 1]
+    else:
+        level_max = float('inf')
+
+    progress = max((xp - level_min) / float(level_max - level_min), 0)
+    return index + 1, progress, level_min, level_max
+
+
+def check_level_rules(level_rules):
+    """ Checks that the levels are numbered from 1 without gaps and need
+        more and more XP.
+
+        :returns: Descriptions of the problems found.
+        :rtype: list
+    """
+
+    if not level_rules:
+        return ['no levels']
+
+    problems = []
+    levels = sorted((int(level), xp) for level, xp in level_rules.iteritems())
+    if [level for level, _ in levels] != range(1, len(levels) + 1):
+        problems.append('levels are not numbered 1 to {}'.format(len(levels)))
+
+    for (level, xp), (_, next_xp) in zip(levels, levels[1:]):
+        if next_xp <= xp:
+            problems.append('level {} needs less XP than level {}'.format(
+                level + 1, level))
+    return problems
+
+
+def is_pushed_back(rules):
+    """ Whether a badge rule has to be evaluated after all the others, as
+        it may depend on the number of offline badges.
+    """
+
+    return 'push_back' in rules and rules['push_back'] is True
+
+
+def is_offline_badge(category, subcat):
+    """ Whether a badge counts towards num_offline_badges. """
+
+    return category == 'badges' and subcat != 'online'
+
+
+def is_badge_achieved(rules, app_state, app_profiles):
+    """ Evaluates the rule of a single badge.
+
+        :param rules: The rule, as found in the rule files.
+        :type rules: dict
+
+        :param app_state: The states of the apps, including 'computed'.
+        :type app_state: dict
+
+        :param app_profiles: Contents of app_profiles.json.
+        :type app_profiles: dict
+
+        :returns: Whether the badge is achieved, None for an unknown
+            operation.
+        :rtype: Boolean
+    """
+
+    if rules['operation'] == 'each_greater':
+        achieved = True
+        for target in rules['targets']:
+            app = target[0]
+            variable = target[1]
+            value = target[2]
+
+            if variable == 'level' and value == -1:
+                value = app_profiles[app]['max_level']
+            if app not in app_state or variable not in app_state[app]:
+                achieved = False
+                break
+            achieved &= app_state[app][variable] >= value
+
+    elif rules['operation'] == 'sum_greater':
+        sum = 0
+        for target in rules['targets']:
+            app = target[0]
+            variable = target[1]
+
+            if app not in app_state or variable not in app_state[app]:
+                continue
+
+            sum += float(app_state[app][variable])
+
+        achieved = sum >= rules['value']
+
+    else:
+        return None
+
+    return achieved
+
+
+def _iter_badge_rules(all_rules):
+    for category, subcats in sorted(all_rules.iteritems()):
+        for subcat, items in sorted(subcats.iteritems()):
+            for item, rules in sorted(items.iteritems()):
+                yield category, subcat, item, rules
+
+
+def check_badge_rules(all_rules, app_profiles):
+    """ Checks that the badge rules can be evaluated.
+
+        :returns: Descriptions of the problems found.
+        :rtype: list
+    """
+
+    problems = []
+    for category, subcat, item, rules in _iter_badge_rules(all_rules):
+        name = '{} {} {}'.format(category, subcat, item)
+
+        if rules.get('operation') not in OPERATIONS:
+            problems.append('{}: unknown operation {}'.format(
+                name, rules.get('operation')))
+            continue
+
+        if rules['operation'] == 'sum_greater' and 'value' not in rules:
+            problems.append('{}: sum_greater without a value'.format(name))
+
+        for target in rules.get('targets', []):
+            if rules['operation'] == 'each_greater' and len(target) != 3:
+                problems.append('{}: bad target {}'.format(name, target))
+                continue
+
+            if len(target) < 2:
+                problems.append('{}: bad target {}'.format(name, target))
+                continue
+
+            if rules['operation'] == 'each_greater' and \
+                    target[1] == 'level' and target[2] == -1:
+                try:
+                    app_profiles[target[0]]['max_level']
+                except (KeyError, TypeError):
+                    problems.append('{}: no max_level for {}'.format(
+                        name, target[0]))
+    return problems
+
+
+def check_badge_names(all_rules):
+    """ Checks that the names of the items match their titles.
+
+        :raises ImportError: The python-slugify module isn't installed.
+
+        :returns: The item name and the expected one for each mismatch.
+        :rtype: list
+    """
+
+    from slugify import slugify
+
+    problems = []
+    for category, subcat, item, rules in _iter_badge_rules(all_rules):
+        slug = slugify(rules['title']).replace('-', '_')
+        if item != slug:
+            problems.append('{} {}'.format(item, slug))
+    return problems
+
+
+def check_badge_images(all_rules):
+    """ Checks that every item has its images and there are no extra ones.
+
+        :returns: The missing and leftover images.
+        :rtype: list
+    """
+
+    try:
+        from kano_profile_gui.paths import image_dir
+    except Exception as e:
+        logger.debug('no media, not checking the images: {}'.format(e))
+        return []
+
+    problems = []
+    for category, subcats in sorted(all_rules.iteritems()):
+        for subcat, items in sorted(subcats.iteritems()):
+            path = os.path.join(image_dir, category, 'originals', subcat)
+            if not os.path.isdir(path):
+                problems.append('{} {}: missing image folder {}'.format(
+                    category, subcat, path))
+                continue
+
+            existing_items = os.listdir(path)
+            needed_items = ['{}.png'.format(f) for f in items.keys()] + \
+                ['{}_locked.png'.format(f) for f in items.keys()]
+
+            for e in sorted(existing_items):
+                if e not in needed_items:
+                    problems.append('{} {}: Leftover image: {}'.format(
+                        category, subcat, e))
+
+            for n in sorted(needed_items):
+                if n not in existing_items:
+                    problems.append('{} {}: Needed image: {}'.format(
+                        category, subcat, n))
+    return problems
+
+
+def find_online_badges(all_rules):
+    """ Returns (category, subcategory, item) of the rules that depend on
+        variables which only come from Kano World.
+    """
+
+    return [(category, subcat, item)
+            for category, subcat, item, rules in _iter_badge_rules(all_rules)
+            if any(target[0] == 'online' for target in rules['targets'])]
+
+
+def compile_rules(sources=None, signature=None, save=True):
+    """ Reads and checks all the rule files and writes the bundle.
+
+        The problems found by the checks are logged and kept in the
+        bundle under 'problems', they don't stop the compilation.
+
+        :param save: Whether to write the bundle into the profile.
+        :type save: Boolean
+
+        :returns: The bundle.
+        :rtype: dict
+    """
+
+    if sources is None:
+        sources = get_rule_sources()
+    if signature is None:
+        signature = get_signature(sources)
+
+    compiled_at = time.time()
+
+    app_profiles = read_json(app_profiles_file)
+    if not app_profiles:
+        logger.error('Error reading app_profiles.json')
+
+    badges = read_badge_rules()
+    levels = read_json(levels_file)
+
+    bundle = {
+        'version': RULES_BUNDLE_VERSION,
+        'sources': sources,
+        'signature': signature,
+        'xp': read_json(xp_file),
+        'levels': levels,
+        'level_table': build_level_table(levels),
+        'app_profiles': app_profiles,
+        'badges': badges,
+        'dependencies': build_badge_dependency_index(badges),
+        'problems': check_level_rules(levels)
+    }
+
+    if badges:
+        bundle['problems'] += check_badge_rules(badges, app_profiles) + \
+            check_badge_images(badges)
+        try:
+            bundle['problems'] += check_badge_names(badges)
+        except ImportError:
+            logger.debug('slugify not available, not checking the badge names')
+    for problem in bundle['problems']:
+        logger.warn('rules: {}'.format(problem))
+
+    # A file changed while it was being read could keep its mtime
+    if not save or is_racy(signature, compiled_at):
+        return bundle
+
+    try:
+        ensure_dir(os.path.dirname(rules_bundle_file))
+        write_file_atomic(rules_bundle_file, _encode_bundle(bundle))
+        fix_ownership(rules_bundle_file)
+    except (IOError, OSError) as e:
+        logger.warn('Unable to save the compiled rules: {}'.format(e))
+
+    return bundle
+
+
+def _encode_bundle(bundle):
+    """ Serializes the bundle to JSON. The keys of the dependency index and
+        the sets of rules in it have no JSON equivalent, they're stored as
+        a list of pairs.
+    """
+
+    data = dict(bundle)
+    data['dependencies'] = sorted(
+        [list(key), sorted(list(rule) for rule in rules)]
+        for key, rules in bundle['dependencies'].iteritems())
+    return json.dumps(data)
+
+
+def _decode_bundle(data):
+    """ The reverse of _encode_bundle(), with the tuples of the signature
+        and the dependency index restored.
+    """
+
+    bundle = dict(data)
+    bundle['signature'] = tuple(tuple(entry) if entry is not None else None
+                                for entry in data['signature'])
+    bundle['dependencies'] = dict(
+        (tuple(key), set(tuple(rule) for rule in rules))
+        for key, rules in data['dependencies'])
+    return bundle
+
+
+def _read_bundle():
+    try:
+        with open(rules_bundle_file, 'r') as bundle_file:
+            data = json.load(bundle_file)
+        if not isinstance(data, dict) or \
+                data.get('version') != RULES_BUNDLE_VERSION:
+            return None
+        return _decode_bundle(data)
+    except Exception:
+        return None
+
+
+def load_rules(read_only=False):
+    """ Returns the compiled rules, compiling them first if any of the
+        source files changed.
+
+        :param read_only: Don't save the bundle if it had to be compiled,
+            for tools that must not write into the profile of whoever runs
+            them.
+        :type read_only: Boolean
+
+        :returns: The contents of xp.json, levels.json and app_profiles.json
+            under 'xp', 'levels' and 'app_profiles', the level table under
+            'level_table', the badge rules as read_badge_rules() under
+            'badges' and their dependency index under 'dependencies'.
+        :rtype: dict
+    """
+
+    global _bundle
+
+    sources = get_rule_sources()
+    signature = get_signature(sources)
+
+    if _bundle is not None and _bundle['sources'] == sources and \
+            _bundle['signature'] == signature:
+        return _bundle
+
+    bundle = _read_bundle()
+    if bundle is None or bundle['sources'] != sources or \
+            bundle['signature'] != signature:
+        logger.debug('compiling the rules')
+        bundle = compile_rules(sources, signature, save=not read_only)
+
+    if not is_racy(signature, time.time()):
+        _bundle = bundle
+    return bundle
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+# stats.py
+#
+# Copyright (C) 2015 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+
+"""
+Running aggregates of the profile, kept up to date on disk
+
+The stats index in stats_index.json holds, for every app listed in xp.json,
+the XP it contributes and the integer values of its variables. It also
+holds whether each badge is achieved. It's tagged with the version of the
+store it was computed from, see AppStateStore.get_version().
+
+Saving the state of an app doesn't touch the index. The first read after a
+change finds the version of the store changed, and re-evaluates only the
+apps whose states differ from the ones the index was computed from, along
+with the badge rules that depend on them. The index is rebuilt from
+scratch when the rules change or it's missing.
+
+As the index module can't depend on kano_profile.apps, the functions that
+may have to read app states take the loader as an argument.
+"""
+
+import json
+import hashlib
+
+from kano.logging import logger
+from kano.utils import read_json, ensure_dir
+from .paths import stats_index_file, kanoprofile_dir
+from .storage import AppStateLock, get_store
+from .atomic import write_json_atomic
+from .ownership import fix_ownership
+from .rules import load_rules, get_level_info, is_badge_achieved, \
+    is_pushed_back, is_offline_badge
+from .xp import calculate_app_xp
+
+STATS_LOCK_FILE = 'stats_index.lock'
+
+
+def _get_rules_id(rules):
+    return hashlib.md5(repr(rules['signature'])).hexdigest()
+
+
+def _lock():
+    ensure_dir(kanoprofile_dir)
+    return AppStateLock(kanoprofile_dir, STATS_LOCK_FILE)
+
+
+def _read_index(rules):
+    index = read_json(stats_index_file)
+    if not index or index.get('rules') != _get_rules_id(rules):
+        return None
+    return index
+
+
+def _is_current(index, version):
+    return index is not None and version is not None and \
+        index.get('version') == version
+
+
+def _write_index(index):
+    write_json_atomic(stats_index_file, index)
+    fix_ownership(stats_index_file)
+
+
+def _get_badge_key(category, subcat, item):
+    return '/'.join([category, subcat, item])
+
+
+def _count_variables(appstate):
+    counts = dict()
+    for variable, value in appstate.iteritems():
+        try:
+            counts[variable] = int(value)
+        except (TypeError, ValueError, OverflowError):
+            pass
+    return counts
+
+
+def _get_app_stats(rules, app_name, appstate):
+    appstate = appstate or dict()
+    return {
+        'xp': calculate_app_xp(rules['xp'][app_name], appstate),
+        'counts': _count_variables(appstate)
+    }
+
+
+def _get_kano_level(rules, index):
+    if not rules['level_table']:
+        return -1
+
+    if not rules['xp']:
+        xp = -1
+    else:
+        # Imported here as the quests pull in the GUI paths
+        from .quests import Quests
+        xp = int(sum(app['xp'] for app in index['apps'].itervalues())) + \
+            Quests().evaluate_xp()
+
+    return get_level_info(rules['level_table'], xp)[0]
+
+
+def _evaluate_badges(rules, index, keys, computed, load_app_state):
+    app_state = {'computed': computed}
+    for category, subcat, item in keys:
+        badge_rules = rules['badges'][category][subcat][item]
+        for target in badge_rules['targets']:
+            if target[0] not in app_state:
+                app_state[target[0]] = load_app_state(target[0]) or dict()
+
+        achieved = is_badge_achieved(badge_rules, app_state,
+                                     rules['app_profiles'])
+        if achieved is not None:
+            index['badges'][_get_badge_key(category, subcat, item)] = achieved
+
+
+def _count_offline_badges(index):
+    count = 0
+    for key, achieved in index['badges'].iteritems():
+        category, subcat, _ = key.split('/', 2)
+        if achieved and is_offline_badge(category, subcat):
+            count += 1
+    return count
+
+
+def _update_badges(rules, index, changed_apps, load_app_state):
+    """ Re-evaluate the badges depending on the apps that changed, or on
+        the computed variables if they changed as a consequence. All the
+        badges are evaluated if changed_apps is None.
+    """
+
+    dependencies = rules['dependencies']
+    affected = set()
+
+    if changed_apps is None:
+        for keys in dependencies.itervalues():
+            affected.update(keys)
+    else:
+        for (app, variable), keys in dependencies.iteritems():
+            if app in changed_apps:
+                affected.update(keys)
+
+    computed = {'kano_level': _get_kano_level(rules, index)}
+    if computed['kano_level'] != index.get('kano_level'):
+        affected.update(dependencies.get(('computed', 'kano_level'), []))
+
+    # normal ones
+    _evaluate_badges(rules, index,
+                     [key for key in affected
+                      if not is_pushed_back(rules['badges'][key[0]][key[1]][key[2]])],
+                     computed, load_app_state)
+
+    computed['num_offline_badges'] = _count_offline_badges(index)
+    if computed['num_offline_badges'] != index.get('num_offline_badges'):
+        affected.update(dependencies.get(('computed', 'num_offline_badges'),
+                                         []))
+
+    # add pushed back ones
+    _evaluate_badges(rules, index,
+                     [key for key in affected
+                      if is_pushed_back(rules['badges'][key[0]][key[1]][key[2]])],
+                     computed, load_app_state)
+
+    index.update(computed)
+
+
+def _get_digests(states):
+    return dict((app, hashlib.md5(json.dumps(data, sort_keys=True))
+                 .hexdigest())
+                for app, data in states.iteritems())
+
+
+def _build_index(rules, version, states):
+    logger.debug('rebuilding the stats index')
+
+    index = {
+        'rules': _get_rules_id(rules),
+        'version': version,
+        'digests': _get_digests(states),
+        'apps': dict((app, _get_app_stats(rules, app, states.get(app)))
+                     for app in rules['xp'] or dict()),
+        'badges': dict()
+    }
+
+    if rules['badges']:
+        _update_badges(rules, index, None,
+                       lambda app: states.get(app, dict()))
+
+    return index
+
+
+def _refresh_index(rules, index, version, states):
+    """ Bring the index up to date with the states, re-evaluating only the
+        apps that changed since it was computed.
+    """
+
+    digests = _get_digests(states)
+    old_digests = index.get('digests', dict())
+    changed_apps = set(app for app in set(digests) | set(old_digests)
+                       if digests.get(app) != old_digests.get(app))
+    logger.debug('refreshing the stats index for {}'.format(
+        ', '.join(sorted(changed_apps))))
+
+    for app in changed_apps:
+        if rules['xp'] and app in rules['xp']:
+            index['apps'][app] = _get_app_stats(rules, app, states.get(app))
+
+    if rules['badges']:
+        _update_badges(rules, index, changed_apps,
+                       lambda app: states.get(app, dict()))
+
+    index['digests'] = digests
+    index['version'] = version
+
+
+def get_stats_index(load_all_app_states):
+    """ Returns the stats index, bringing it up to date first if the
+        states changed since it was written.
+
+        :param load_all_app_states: Used to read the states of all the apps
+            when the index needs to be refreshed. It must only return what
+            is in the store, as the index is tagged with its version.
+        :type load_all_app_states: function
+
+        :returns: The XP and the integer variables of the apps under 'apps',
+            the achieved flags of the badges indexed by
+            'category/subcategory/item' under 'badges', and the computed
+            'kano_level' and 'num_offline_badges'.
+        :rtype: dict
+    """
+
+    rules = load_rules()
+    store = get_store()
+    index = _read_index(rules)
+    if _is_current(index, store.get_version()):
+        return index
+
+    with _lock():
+        # The version is read before the states, a change made in between
+        # will be picked up by the next call
+        version = store.get_version()
+
+        # Someone else might have refreshed it while we were waiting
+        index = _read_index(rules)
+        if _is_current(index, version):
+            return index
+
+        states = load_all_app_states()
+        if index is None:
+            index = _build_index(rules, version, states)
+        else:
+            _refresh_index(rules, index, version, states)
+
+        # Without a version the next call would refresh it again anyway
+        if version is not None:
+            _write_index(index)
+
+    return index
+
+
+def get_app_xps(load_all_app_states):
+    """ Returns the XP contribution of every app listed in xp.json.
+
+        :rtype: dict
+    """
+
+    index = get_stats_index(load_all_app_states)
+    return dict((app, stats['xp']) for app, stats in index['apps'].iteritems())
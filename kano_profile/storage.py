@@ -0,0 +1,857 @@
+#!/usr/bin/env python
+
+# storage.py
+#
+# Copyright (C) 2015 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+
+"""
+Storage backends for application states
+
+The states used to be kept in one JSON file per application
+(~/.kanoprofile/apps/<app>/state.json). Reading all of them meant opening
+and parsing every single file, which is slow on an SD card. The default
+backend keeps everything in a single SQLite database with one row per
+(app, variable) pair instead. The old JSON tree is imported into it the
+first time the database is opened and left on disk untouched, only as a
+backup: it's never updated afterwards, so it must not be read as the
+current state.
+"""
+
+import os
+import time
+import json
+import fcntl
+import errno
+import shutil
+import urllib
+import hashlib
+import tempfile
+import threading
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+from kano.logging import logger
+from kano.utils import read_json, ensure_dir
+from .paths import apps_dir, app_state_db
+from .ownership import fix_ownership
+from .cache import get_signature, is_racy
+from .atomic import write_json_atomic, get_fsync_policy, FSYNC_NONE, \
+    FSYNC_DATA
+
+APP_STATE_FILE = 'state.json'
+APP_LOCK_FILE = 'state.lock'
+
+DEFAULT_BACKEND = 'sqlite'
+BACKEND_ENV_VAR = 'KANO_PROFILE_STORE'
+
+
+def apply_changes(data, updates=None, increments=None):
+    """ Set and increment variables of a loaded state in place.
+
+        :param updates: Values to set, indexed by the variable name.
+        :type updates: dict
+        :param increments: Amounts to add, indexed by the variable name.
+            Variables that don't exist yet start from 0.
+        :type increments: dict
+    """
+
+    if updates:
+        data.update(updates)
+
+    if increments:
+        for variable, value in increments.iteritems():
+            if variable not in data:
+                data[variable] = 0
+            data[variable] += value
+
+
+class AppState(dict):
+    """ The state of an app as returned by the stores.
+
+        It remembers how far into the journal of deltas it was loaded, so
+        that saving it back only drops the increments that were folded into
+        it. Plain dicts can be saved as well, they replace the state and
+        all the pending increments.
+    """
+
+    journal_mark = None
+
+    def __init__(self, data=None, journal_mark=None):
+        super(AppState, self).__init__(data or ())
+        self.journal_mark = journal_mark
+
+
+class AppStateLock(object):
+    """ An exclusive advisory lock (see flock(2)) on a single app's state,
+        to be used within controlled execution statements.
+
+        The lock is re-entrant within a process, so functions that take it
+        can be freely called while it is already held.
+    """
+
+    _held = {}
+
+    def __init__(self, app_dir, lock_file=APP_LOCK_FILE):
+        self._path = os.path.join(app_dir, lock_file)
+
+    def __enter__(self):
+        if self._path in self._held:
+            lock_file, depth = self._held[self._path]
+            self._held[self._path] = (lock_file, depth + 1)
+            return self
+
+        ensure_dir(os.path.dirname(self._path))
+        lock_file = open(self._path, 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        fix_ownership(self._path)
+
+        self._held[self._path] = (lock_file, 1)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        lock_file, depth = self._held[self._path]
+        if depth > 1:
+            self._held[self._path] = (lock_file, depth - 1)
+        else:
+            del self._held[self._path]
+            lock_file.close()
+
+
+class AppStateStore(object):
+    """ The interface every app state backend has to implement.
+
+        Increments don't modify the state directly. They are appended to a
+        per-app journal of deltas instead, which is folded into the state
+        when it's read and merged into it on the next save or once it grows
+        past COMPACT_THRESHOLD entries.
+    """
+
+    name = None
+
+    COMPACT_THRESHOLD = 500
+
+    def __init__(self, apps_dir, read_only=False):
+        """
+            :param read_only: Only ever read the states: the journals aren't
+                compacted and nothing, not even a lock file, is created.
+                Used for profiles that belong to someone else.
+            :type read_only: Boolean
+        """
+
+        self.apps_dir = apps_dir
+        self.read_only = read_only
+
+    def get_app_dir(self, app_name):
+        return os.path.join(self.apps_dir, app_name)
+
+    def lock(self, app_name):
+        """ Returns a lock object guarding the state of an app. """
+
+        self._check_writable()
+        return AppStateLock(self.get_app_dir(app_name))
+
+    def _check_writable(self):
+        if self.read_only:
+            raise IOError(errno.EROFS, 'The app states are opened read-only',
+                          self.apps_dir)
+
+    def close(self):
+        """ Release the resources held by the store. """
+
+        pass
+
+    def list_apps(self):
+        raise NotImplementedError
+
+    def load(self, app_name):
+        """ Load the state of an app with the journal folded in.
+
+            :rtype: AppState
+        """
+
+        data, deltas = self._load(app_name)
+        if deltas > self.COMPACT_THRESHOLD and not self.read_only:
+            data = self.compact(app_name)
+        return data
+
+    def _load(self, app_name):
+        """ Load the state of an app with the journal folded in.
+
+            :returns: The state, with the mark of the last delta folded in,
+                and the number of journalled deltas.
+            :rtype: tuple
+        """
+
+        raise NotImplementedError
+
+    def load_variable(self, app_name, variable):
+        """ Load a single variable of an app.
+
+            :returns: The value or None if it isn't set.
+        """
+
+        return self.load(app_name).get(variable)
+
+    def load_all(self):
+        """ Load the states of all the apps at once.
+
+            :returns: AppState objects indexed by the app name.
+            :rtype: dict
+        """
+
+        raise NotImplementedError
+
+    def save(self, app_name, data, journal_mark=None):
+        """ Replace the state of an app.
+
+            Only the deltas up to the journal mark are dropped, increments
+            that arrived after the data was loaded are kept.
+
+            :param journal_mark: The mark of the last delta folded into the
+                data. Defaults to the one the data was loaded with if it's an
+                AppState, otherwise all the deltas are dropped.
+        """
+
+        raise NotImplementedError
+
+    def _get_journal_mark(self, data, journal_mark):
+        if journal_mark is None:
+            journal_mark = getattr(data, 'journal_mark', None)
+        return journal_mark
+
+    def get_cache_paths(self, app_name=None):
+        """ Returns the files that back the state of an app, or of all the
+            apps if no name is given. Used to validate cached states.
+        """
+
+        raise NotImplementedError
+
+    def get_version(self):
+        """ Returns a value that changes whenever the state of any app does,
+            or None if the current version can't be told apart from the next
+            one yet. Used to validate data derived from the states.
+        """
+
+        raise NotImplementedError
+
+    def update(self, app_name, updates=None, increments=None):
+        """ Set and increment several variables in one transaction, see
+            apply_changes().
+        """
+
+        with self.lock(app_name):
+            data, _ = self._load(app_name)
+            apply_changes(data, updates, increments)
+            self.save(app_name, data, data.journal_mark)
+
+    def increment(self, app_name, variable, value):
+        """ Atomically add a value to a numeric variable without reading
+            or rewriting the rest of the state.
+        """
+
+        raise NotImplementedError
+
+    def compact(self, app_name):
+        """ Merge the journal of deltas into the state of an app.
+
+            :returns: The compacted state.
+            :rtype: AppState
+        """
+
+        with self.lock(app_name):
+            data, _ = self._load(app_name)
+            self.save(app_name, data, data.journal_mark)
+        return data
+
+    def _fold_delta(self, app_name, data, variable, delta):
+        try:
+            data[variable] = data.get(variable, 0) + delta
+        except TypeError:
+            msg = 'Dropping increment of non-numeric {}:{}'.format(app_name,
+                                                                   variable)
+            logger.warn(msg)
+
+
+class JsonTreeStore(AppStateStore):
+    """ The original layout, one state.json file per application.
+
+        Increments are appended as JSON lines to state.journal next to it,
+        numbered with a sequence number that keeps growing when the journal
+        is trimmed. The journal mark of a state is the sequence number of
+        the last delta folded into it.
+    """
+
+    name = 'json'
+
+    APP_JOURNAL_FILE = 'state.journal'
+
+    # How many bytes at the end of the journal to read to find the last
+    # sequence number, way more than a single entry takes
+    SEQ_LOOKBACK = 4096
+
+    def get_state_file(self, app_name):
+        return os.path.join(self.get_app_dir(app_name), APP_STATE_FILE)
+
+    def get_journal_file(self, app_name):
+        return os.path.join(self.get_app_dir(app_name), self.APP_JOURNAL_FILE)
+
+    def get_cache_paths(self, app_name=None):
+        if app_name is not None:
+            return [self.get_state_file(app_name),
+                    self.get_journal_file(app_name)]
+
+        paths = [self.apps_dir]
+        for app in self.list_apps():
+            paths += self.get_cache_paths(app)
+        return paths
+
+    def get_version(self):
+        # Every save replaces state.json and every increment grows the
+        # journal, so their stat signatures identify the states
+        now = time.time()
+        signature = get_signature(self.get_cache_paths())
+        if is_racy(signature, now):
+            return None
+        return hashlib.md5(repr(signature)).hexdigest()
+
+    def list_apps(self):
+        if not os.path.isdir(self.apps_dir):
+            return []
+
+        return [app for app in os.listdir(self.apps_dir)
+                if os.path.isfile(self.get_state_file(app)) or
+                os.path.isfile(self.get_journal_file(app))]
+
+    def _load(self, app_name):
+        data = AppState(read_json(self.get_state_file(app_name)))
+
+        deltas, data.journal_mark = self._read_journal(app_name)
+        for variable, delta in deltas:
+            self._fold_delta(app_name, data, variable, delta)
+
+        return data, len(deltas)
+
+    def load_all(self):
+        states = dict()
+        for app in self.list_apps():
+            data = self.load(app)
+            if data:
+                states[app] = data
+        return states
+
+    def save(self, app_name, data, journal_mark=None):
+        self._check_writable()
+        state_file = self.get_state_file(app_name)
+        ensure_dir(self.get_app_dir(app_name))
+        write_json_atomic(state_file, data)
+        fix_ownership(state_file)
+
+        self._trim_journal(app_name,
+                           self._get_journal_mark(data, journal_mark))
+
+    def increment(self, app_name, variable, value):
+        self._check_writable()
+        journal_file = self.get_journal_file(app_name)
+        ensure_dir(self.get_app_dir(app_name))
+
+        with open(journal_file, 'a+') as journal:
+            fcntl.flock(journal, fcntl.LOCK_EX)
+            seq = self._read_last_seq(journal) + 1
+            journal.write(json.dumps([variable, value, seq]) + '\n')
+        fix_ownership(journal_file)
+
+    def _parse_entry(self, line, journal_file):
+        """ Returns the (variable, delta, seq) triple of a journal line, or
+            None if it's corrupted. Entries written before the sequence
+            numbers were introduced are numbered 0.
+        """
+
+        try:
+            entry = json.loads(line)
+            variable, delta = entry[:2]
+            seq = entry[2] if len(entry) > 2 else 0
+        except (ValueError, TypeError):
+            logger.warn('Corrupted journal entry in {}'.format(journal_file))
+            return None
+        return variable, delta, seq
+
+    def _iter_journal(self, journal, journal_file):
+        for line in journal:
+            # A torn last line will be completed by its writer
+            if not line.endswith('\n'):
+                break
+            entry = self._parse_entry(line, journal_file)
+            if entry is not None:
+                yield line, entry
+
+    def _read_last_seq(self, journal):
+        journal.seek(0, os.SEEK_END)
+        size = journal.tell()
+        journal.seek(max(0, size - self.SEQ_LOOKBACK))
+        lines = journal.read().splitlines(True)
+        for line in reversed(lines):
+            if line.endswith('\n'):
+                entry = self._parse_entry(line, journal.name)
+                if entry is not None:
+                    return entry[2]
+        return 0
+
+    def _read_journal(self, app_name):
+        """ Returns the deltas in the journal of an app and the sequence
+            number of the last one.
+        """
+
+        journal_file = self.get_journal_file(app_name)
+        deltas = []
+        mark = 0
+        if not os.path.exists(journal_file):
+            return deltas, mark
+
+        with open(journal_file, 'r') as journal:
+            fcntl.flock(journal, fcntl.LOCK_SH)
+            for _, (variable, delta, seq) in self._iter_journal(journal,
+                                                                 journal_file):
+                mark = max(mark, seq)
+                # Placeholders only carry the sequence number over a trim
+                if variable is not None:
+                    deltas.append((variable, delta))
+
+        return deltas, mark
+
+    def _trim_journal(self, app_name, mark=None):
+        """ Drop the deltas numbered up to the mark, or all of them if it's
+            None.
+        """
+
+        journal_file = self.get_journal_file(app_name)
+        if not os.path.exists(journal_file):
+            return
+
+        with open(journal_file, 'r+') as journal:
+            fcntl.flock(journal, fcntl.LOCK_EX)
+            kept = []
+            last_seq = 0
+            for line, (variable, _, seq) in self._iter_journal(journal,
+                                                                journal_file):
+                last_seq = max(last_seq, seq)
+                if variable is not None and mark is not None and seq > mark:
+                    kept.append(line)
+
+            # Keep the numbering going, marks handed out earlier must never
+            # match the deltas appended after this
+            if not kept and last_seq:
+                kept.append(json.dumps([None, 0, last_seq]) + '\n')
+
+            journal.seek(0)
+            journal.write(''.join(kept))
+            journal.truncate()
+
+
+class SqliteStore(AppStateStore):
+    """ All the app states in a single SQLite database, one row per
+        (app, variable) pair with JSON encoded values.
+
+        Increments are rows in the app_state_delta table. The journal mark
+        of a state is the highest delta id at the time it was loaded.
+    """
+
+    name = 'sqlite'
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS app_state ('
+        '    app TEXT NOT NULL,'
+        '    variable TEXT NOT NULL,'
+        '    value TEXT NOT NULL,'
+        '    PRIMARY KEY (app, variable))',
+        'CREATE TABLE IF NOT EXISTS app_state_delta ('
+        '    id INTEGER PRIMARY KEY AUTOINCREMENT,'
+        '    app TEXT NOT NULL,'
+        '    variable TEXT NOT NULL,'
+        '    delta NUMERIC NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS app_state_delta_app '
+        '    ON app_state_delta (app)',
+        'CREATE TABLE IF NOT EXISTS meta ('
+        '    key TEXT PRIMARY KEY,'
+        '    value TEXT)'
+    ]
+
+    MIGRATED_KEY = 'migrated_from_json'
+    GENERATION_KEY = 'generation'
+
+    def __init__(self, apps_dir, db_path, read_only=False):
+        super(SqliteStore, self).__init__(apps_dir, read_only)
+        self.db_path = db_path
+        self._conn = None
+        self._conn_pid = None
+        self._copy_dir = None
+
+        # The connection is shared by all the threads of the process
+        self._thread_lock = threading.RLock()
+
+    def _connect(self):
+        # Connections can't be shared with forked children
+        if self._conn is not None and self._conn_pid == os.getpid():
+            return self._conn
+
+        if self.read_only:
+            self._conn = self._connect_read_only()
+            self._conn_pid = os.getpid()
+            return self._conn
+
+        ensure_dir(os.path.dirname(self.db_path))
+        is_new = not os.path.exists(self.db_path)
+
+        conn = sqlite3.connect(self.db_path, timeout=10,
+                               isolation_level=None,
+                               check_same_thread=False)
+        for statement in self.SCHEMA:
+            conn.execute(statement)
+
+        # SQLite commits are atomic already, only follow the fsync policy
+        synchronous = {
+            FSYNC_NONE: 'OFF',
+            FSYNC_DATA: 'NORMAL'
+        }.get(get_fsync_policy(), 'FULL')
+        conn.execute('PRAGMA synchronous = {}'.format(synchronous))
+
+        if is_new:
+            fix_ownership(self.db_path)
+
+        self._conn = conn
+        self._conn_pid = os.getpid()
+
+        self._migrate_json_tree()
+        return conn
+
+    def _connect_read_only(self):
+        """ Opens the database without creating, migrating or recovering
+            anything.
+        """
+
+        uri = 'file:{}?mode=ro'.format(urllib.pathname2url(self.db_path))
+        try:
+            conn = sqlite3.connect(uri, uri=True, timeout=10,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+        except TypeError:
+            # Python 2 can't open URI filenames. Opening the database
+            # normally could still write to it, to roll back a transaction
+            # interrupted by a crash, so a copy is read instead.
+            self._copy_dir = tempfile.mkdtemp(prefix='kano-profile-')
+            copy = os.path.join(self._copy_dir, os.path.basename(self.db_path))
+            for suffix in ['', '-journal', '-wal']:
+                if os.path.exists(self.db_path + suffix):
+                    shutil.copyfile(self.db_path + suffix, copy + suffix)
+            conn = sqlite3.connect(copy, timeout=10, isolation_level=None,
+                                   check_same_thread=False)
+
+        conn.execute('PRAGMA query_only = ON')
+        return conn
+
+    def close(self):
+        with self._thread_lock:
+            if self._conn is not None and self._conn_pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+            if self._copy_dir is not None:
+                shutil.rmtree(self._copy_dir, ignore_errors=True)
+                self._copy_dir = None
+
+    def _transaction(self, mode='IMMEDIATE'):
+        with self._thread_lock:
+            return _SqliteTransaction(self._connect(), self._thread_lock,
+                                      mode)
+
+    def _migrate_json_tree(self):
+        """ One-time import of the state.json files into the database.
+
+            Apps that are already present in the database are skipped, so
+            a migration interrupted half way through can be safely re-run.
+        """
+
+        with self._transaction() as conn:
+            row = conn.execute('SELECT value FROM meta WHERE key = ?',
+                               (self.MIGRATED_KEY,)).fetchone()
+            if row:
+                return
+
+            states = JsonTreeStore(self.apps_dir).load_all()
+            for app_name, data in states.iteritems():
+                exists = conn.execute(
+                    'SELECT 1 FROM app_state WHERE app = ? LIMIT 1',
+                    (app_name,)).fetchone()
+                if exists:
+                    continue
+                self._insert(conn, app_name, data)
+
+            conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                         (self.MIGRATED_KEY, '1'))
+            self._bump_generation(conn)
+
+        logger.info('Migrated {} app states to {}'.format(len(states),
+                                                         self.db_path))
+
+    def _insert(self, conn, app_name, data):
+        conn.executemany(
+            'INSERT OR REPLACE INTO app_state VALUES (?, ?, ?)',
+            [(app_name, variable, json.dumps(value))
+             for variable, value in data.iteritems()])
+
+    def _fold_deltas(self, conn, states, app_name=None):
+        """ Add the journalled deltas to the loaded states.
+
+            :returns: Number of deltas per app.
+            :rtype: dict
+        """
+
+        query = 'SELECT app, variable, SUM(delta), COUNT(*) ' + \
+            'FROM app_state_delta'
+        args = ()
+        if app_name is not None:
+            query += ' WHERE app = ?'
+            args = (app_name,)
+        query += ' GROUP BY app, variable'
+
+        counts = dict()
+        for app, variable, delta, count in conn.execute(query, args):
+            self._fold_delta(app, states.setdefault(app, dict()), variable,
+                             delta)
+            counts[app] = counts.get(app, 0) + count
+
+        return counts
+
+    def _last_delta_id(self, conn):
+        last_id, = conn.execute('SELECT MAX(id) FROM app_state_delta') \
+            .fetchone()
+        return last_id or 0
+
+    def get_cache_paths(self, app_name=None):
+        return [self.db_path]
+
+    def get_version(self):
+        with self._transaction('DEFERRED') as conn:
+            row = conn.execute('SELECT value FROM meta WHERE key = ?',
+                               (self.GENERATION_KEY,)).fetchone()
+        return int(row[0]) if row else 0
+
+    def _bump_generation(self, conn):
+        """ Count the changes in the transaction making them, so the count
+            can't get out of sync with the states.
+        """
+
+        conn.execute(
+            'INSERT OR REPLACE INTO meta VALUES (?, COALESCE(' +
+            '(SELECT value FROM meta WHERE key = ?), 0) + 1)',
+            (self.GENERATION_KEY, self.GENERATION_KEY))
+
+    def list_apps(self):
+        with self._transaction('DEFERRED') as conn:
+            rows = conn.execute('SELECT app FROM app_state ' +
+                                'UNION SELECT app FROM app_state_delta')
+            return [app for app, in rows]
+
+    def _load(self, app_name):
+        states = {app_name: AppState()}
+
+        # Read the values and the deltas from a consistent snapshot
+        with self._transaction('DEFERRED') as conn:
+            rows = conn.execute(
+                'SELECT variable, value FROM app_state WHERE app = ?',
+                (app_name,))
+            for variable, value in rows:
+                states[app_name][variable] = json.loads(value)
+
+            counts = self._fold_deltas(conn, states, app_name)
+            states[app_name].journal_mark = self._last_delta_id(conn)
+
+        return states[app_name], counts.get(app_name, 0)
+
+    def load_variable(self, app_name, variable):
+        with self._transaction('DEFERRED') as conn:
+            data = self._load_variable(conn, app_name, variable)
+        return data.get(variable)
+
+    def _load_variable(self, conn, app_name, variable):
+        """ Returns a dict with just the variable in it, if it's set. """
+
+        data = dict()
+        row = conn.execute(
+            'SELECT value FROM app_state WHERE app = ? AND variable = ?',
+            (app_name, variable)).fetchone()
+        if row:
+            data[variable] = json.loads(row[0])
+
+        delta, count = conn.execute(
+            'SELECT SUM(delta), COUNT(*) FROM app_state_delta ' +
+            'WHERE app = ? AND variable = ?', (app_name, variable)).fetchone()
+        if count:
+            self._fold_delta(app_name, data, variable, delta)
+
+        return data
+
+    def load_all(self):
+        states = dict()
+
+        with self._transaction('DEFERRED') as conn:
+            rows = conn.execute('SELECT app, variable, value FROM app_state')
+            for app_name, variable, value in rows:
+                states.setdefault(app_name, dict())[variable] = \
+                    json.loads(value)
+
+            counts = self._fold_deltas(conn, states)
+            last_id = self._last_delta_id(conn)
+
+            migrated = conn.execute('SELECT value FROM meta WHERE key = ?',
+                                    (self.MIGRATED_KEY,)).fetchone()
+
+        states = dict((app_name, AppState(data, last_id))
+                      for app_name, data in states.iteritems())
+
+        if self.read_only:
+            if not migrated:
+                # The import is left to the owner, see _migrate_json_tree()
+                json_tree = JsonTreeStore(self.apps_dir, read_only=True)
+                for app_name, data in json_tree.load_all().iteritems():
+                    states.setdefault(app_name, data)
+            return states
+
+        for app_name, count in counts.iteritems():
+            if count > self.COMPACT_THRESHOLD:
+                states[app_name] = self.compact(app_name)
+
+        return states
+
+    def save(self, app_name, data, journal_mark=None):
+        self._check_writable()
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM app_state WHERE app = ?', (app_name,))
+            self._insert(conn, app_name, data)
+
+            mark = self._get_journal_mark(data, journal_mark)
+            if mark is None:
+                conn.execute('DELETE FROM app_state_delta WHERE app = ?',
+                             (app_name,))
+            else:
+                conn.execute(
+                    'DELETE FROM app_state_delta WHERE app = ? AND id <= ?',
+                    (app_name, mark))
+
+            self._bump_generation(conn)
+
+    def update(self, app_name, updates=None, increments=None):
+        self._check_writable()
+        updates = updates or dict()
+        increments = increments or dict()
+        changes = dict()
+
+        with self._transaction() as conn:
+            for variable in set(updates) | set(increments):
+                if variable in updates:
+                    # The journalled increments are superseded by the value
+                    data = {variable: updates[variable]}
+                else:
+                    data = self._load_variable(conn, app_name, variable)
+
+                if variable in increments:
+                    apply_changes(data, increments={
+                        variable: increments[variable]
+                    })
+
+                changes[variable] = data[variable]
+                conn.execute(
+                    'DELETE FROM app_state_delta ' +
+                    'WHERE app = ? AND variable = ?', (app_name, variable))
+
+            self._insert(conn, app_name, changes)
+            self._bump_generation(conn)
+
+    def increment(self, app_name, variable, value):
+        self._check_writable()
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT INTO app_state_delta (app, variable, delta) ' +
+                'VALUES (?, ?, ?)', (app_name, variable, value))
+            self._bump_generation(conn)
+
+
+class _SqliteTransaction(object):
+    """ BEGIN ... COMMIT, rolled back on exceptions. The thread lock is
+        held for the duration of the transaction.
+    """
+
+    def __init__(self, conn, thread_lock, mode='IMMEDIATE'):
+        self._conn = conn
+        self._thread_lock = thread_lock
+        self._mode = mode
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        try:
+            self._conn.execute('BEGIN {}'.format(self._mode))
+        except Exception:
+            self._thread_lock.release()
+            raise
+        return self._conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self._conn.execute('COMMIT')
+            else:
+                self._conn.execute('ROLLBACK')
+        finally:
+            self._thread_lock.release()
+
+
+BACKENDS = {
+    JsonTreeStore.name: lambda: JsonTreeStore(apps_dir),
+    SqliteStore.name: lambda: SqliteStore(apps_dir, app_state_db),
+}
+
+_store = None
+
+
+def register_backend(name, factory):
+    """ Make another storage backend available.
+
+        :param name: Name of the backend, as used in KANO_PROFILE_STORE.
+        :type name: str
+
+        :param factory: Callable returning an AppStateStore instance.
+        :type factory: function
+    """
+
+    BACKENDS[name] = factory
+
+
+def get_store():
+    """ Returns the app state store used by this process.
+
+        The backend can be chosen using the KANO_PROFILE_STORE environment
+        variable, SQLite is used by default if it is available.
+
+        :returns: The store.
+        :rtype: AppStateStore
+    """
+
+    global _store
+
+    if _store is None:
+        name = os.environ.get(BACKEND_ENV_VAR, DEFAULT_BACKEND)
+        if name not in BACKENDS:
+            logger.warn('Unknown app state backend {}'.format(name))
+            name = DEFAULT_BACKEND
+
+        if name == SqliteStore.name and sqlite3 is None:
+            logger.warn('sqlite3 not available, using the JSON app states')
+            name = JsonTreeStore.name
+
+        _store = BACKENDS[name]()
+
+    return _store
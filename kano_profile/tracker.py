@@ -13,7 +13,9 @@ A small module for tracking various metrics the users do in Kano OS
 """
 
 import time
+import copy
 import atexit
+import calendar
 import datetime
 import fcntl
 import json
@@ -21,14 +23,19 @@ import os
 import hashlib
 import subprocess
 import shlex
+import signal
+import threading
 
 from kano.utils import get_program_name, is_number, read_file_contents, \
-    get_cpu_id, chown_path, ensure_dir
+    get_cpu_id, ensure_dir
 from kano.logging import logger
-from kano_profile.apps import get_app_state_file, load_app_state_variable, \
+from kano_profile.apps import lock_app_state, load_app_state_variable, \
     save_app_state_variable
+from kano_profile.ownership import fix_ownership
 from kano_profile.paths import tracker_dir, tracker_events_file, \
-    tracker_token_file
+    tracker_events_dir, tracker_token_file
+from kano_profile.event_log import EventLog, iter_events, \
+    get_sequence_number
 
 
 class open_locked(file):
@@ -86,18 +93,11 @@ def generate_tracker_token():
     else:
         with f:
             f.write(token)
-        if 'SUDO_USER' in os.environ:
-            chown_path(tracker_token_file)
+        fix_ownership(tracker_token_file)
 
-    # Make sure that the events file exist
-    try:
-        f = open(tracker_events_file, 'a')
-    except IOError as e:
-        logger.error('Error opening tracker events file {}'.format(e))
-    else:
-        f.close()
-        if 'SUDO_USER' in os.environ:
-            chown_path(tracker_events_file)
+    # Make sure that the events directory exists
+    ensure_dir(tracker_events_dir)
+    fix_ownership(tracker_events_dir)
 
     return token
 
@@ -106,6 +106,150 @@ OS_VERSION = str(read_file_contents('/etc/kanux_version'))
 CPU_ID = str(get_cpu_id())
 TOKEN = load_token()
 
+event_log = EventLog(tracker_events_dir, legacy_file=tracker_events_file)
+
+# Buffered events are written out once there are this many of them or the
+# oldest one has waited for this many seconds
+EVENT_BUFFER_SIZE = 50
+EVENT_BUFFER_DELAY = 2
+
+
+class EventBuffer(object):
+    """ Collects the events tracked by this process and appends them to the
+        event log in batches, with a single locked write per batch.
+
+        A batch is written once EVENT_BUFFER_SIZE events are waiting, at
+        most EVENT_BUFFER_DELAY seconds after the first of them was added,
+        when flush() is called and when the process exits or receives
+        SIGTERM.
+    """
+
+    def __init__(self, log=event_log, size=EVENT_BUFFER_SIZE,
+                 delay=EVENT_BUFFER_DELAY):
+        self.log = log
+        self.size = size
+        self.delay = delay
+        self._events = []
+        self._lock = threading.RLock()
+        self._timer = None
+        self._last_timer = None
+        self._exit_hooks_installed = False
+        self._previous_sigterm_handler = None
+
+    def add(self, event):
+        """ Queue an event to be written.
+
+            :param event: The event, must be compatible with JSON.
+            :type event: dict
+        """
+
+        self.add_many([event])
+
+    def add_many(self, events):
+        """ Queue several events at once, see add(). """
+
+        with self._lock:
+            self._events += events
+
+            if not self._exit_hooks_installed:
+                self._install_exit_hooks()
+
+            if len(self._events) >= self.size:
+                self.flush()
+            elif self._events and self._timer is None:
+                self._timer = threading.Timer(self.delay, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+                self._last_timer = self._timer
+
+    def flush(self):
+        """ Write out all the buffered events.
+
+            :returns: The number of events written.
+            :rtype: int
+        """
+
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+            events = self._events
+            self._events = []
+            if not events:
+                return 0
+
+            try:
+                try:
+                    self.log.append(events, TOKEN)
+                except (TypeError, ValueError):
+                    # Don't lose the whole batch because of one event
+                    events = [event for event in events
+                              if _is_serialisable(event)]
+                    self.log.append(events, TOKEN)
+            except (IOError, OSError) as e:
+                logger.error('Error writing tracker events {}'.format(e))
+                return 0
+
+            return len(events)
+
+    def _install_exit_hooks(self):
+        atexit.register(self._flush_at_exit)
+        self._exit_hooks_installed = True
+
+        try:
+            self._previous_sigterm_handler = signal.signal(
+                signal.SIGTERM, self._flush_on_sigterm)
+        except ValueError:
+            # Signal handlers can only be installed from the main thread
+            logger.warn('Buffered tracker events will not be flushed on '
+                        'SIGTERM')
+            self._previous_sigterm_handler = signal.SIG_DFL
+
+    def _flush_on_sigterm(self, signum, frame):
+        self.flush()
+
+        previous = self._previous_sigterm_handler
+        if callable(previous):
+            previous(signum, frame)
+        elif previous != signal.SIG_IGN:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    def _flush_at_exit(self):
+        with self._lock:
+            timer = self._last_timer
+            self.flush()
+
+        # Let the cancelled timer finish, the interpreter complains about
+        # threads still waiting when it shuts down
+        if timer is not None and timer is not threading.current_thread():
+            timer.join()
+
+    def __len__(self):
+        return len(self._events)
+
+
+def _is_serialisable(event):
+    try:
+        json.dumps(event)
+    except (TypeError, ValueError) as e:
+        logger.error('Dropping tracker event {}: {}'.format(
+            event.get('name'), e))
+        return False
+    return True
+
+
+event_buffer = EventBuffer()
+
+
+def flush_tracker_events():
+    """ Write out the events tracked by this process that are still
+        buffered in memory.
+    """
+
+    return event_buffer.flush()
+
 
 def get_session_file_path(name, pid):
     return "{}/{}-{}.json".format(tracker_dir, pid, name)
@@ -133,8 +277,7 @@ def session_start(name, pid=None):
     else:
         with f:
             json.dump(data, f)
-        if 'SUDO_USER' in os.environ:
-            chown_path(path)
+        fix_ownership(path)
 
     return path
 
@@ -165,8 +308,7 @@ def session_end(session_file):
             else:
                 with wf:
                     json.dump(data, wf)
-        if 'SUDO_USER' in os.environ:
-            chown_path(session_file)
+        fix_ownership(session_file)
 
 
 def session_log(name, started, length):
@@ -182,22 +324,13 @@ def session_log(name, started, length):
         :param started: int
     """
 
-    try:
-        af = open_locked(tracker_events_file, 'a')
-    except IOError as e:
-        logger.error('Error while opening events file'.format(e))
-    else:
-        with af:
-            session = {
-                "name": name,
-                "started": int(started),
-                "elapsed": int(length)
-            }
+    session = {
+        "name": name,
+        "started": int(started),
+        "elapsed": int(length)
+    }
 
-            event = get_session_event(session)
-            af.write(json.dumps(event) + "\n")
-        if 'SUDO_USER' in os.environ:
-            chown_path(tracker_events_file)
+    event_buffer.add(get_session_event(session))
 
 
 def track_data(name, data):
@@ -221,18 +354,12 @@ def track_data(name, data):
         "token": TOKEN,
 
         "name": str(name),
-        "data": data
+
+        # Buffered for a while, keep the data as it is now
+        "data": copy.deepcopy(data)
     }
 
-    try:
-        af = open_locked(tracker_events_file, "a")
-    except IOError as e:
-        logger.error('Error opening tracker events file {}'.format(e))
-    else:
-        with af:
-            af.write(json.dumps(event) + "\n")
-        if 'SUDO_USER' in os.environ:
-            chown_path(tracker_events_file)
+    event_buffer.add(event)
 
 
 def track_action(name):
@@ -242,16 +369,7 @@ def track_action(name):
         :type name: str
     """
 
-    try:
-        af = open_locked(tracker_events_file, 'a')
-    except IOError as e:
-        logger.error('Error opening tracker events file {}'.format(e))
-    else:
-        with af:
-            event = get_action_event(name)
-            af.write(json.dumps(event) + "\n")
-        if 'SUDO_USER' in os.environ:
-            chown_path(tracker_events_file)
+    event_buffer.add(get_action_event(name))
 
 
 def track_subprocess(name, cmd):
@@ -340,12 +458,117 @@ def _get_nearest_previous_monday():
     return int(r)
 
 
+# How much of the per-app usage history is kept in the tracker's state.
+# Weeks older than WEEKS_KEPT are rolled into monthly totals, months older
+# than MONTHS_KEPT into yearly ones. The overall totals are never affected.
+WEEKS_KEPT = 12
+MONTHS_KEPT = 24
+YEARS_KEPT = 10
+
+# Stats of the least recently used apps are dropped beyond this many apps
+MAX_TRACKED_APPS = 100
+
+
+def _add_to_bucket(buckets, key, starts, runtime):
+    bucket = buckets.setdefault(key, {'starts': 0, 'runtime': 0})
+    bucket['starts'] += starts
+    bucket['runtime'] += runtime
+
+
+def _roll_up(buckets, parents, keep, get_parent_key):
+    """ Moves all but the newest `keep` buckets into their parent buckets. """
+
+    old_keys = sorted(buckets, key=_get_bucket_start)[:-keep]
+    for key in old_keys:
+        bucket = buckets.pop(key)
+        if parents is not None:
+            _add_to_bucket(parents, get_parent_key(key),
+                           bucket.get('starts', 0), bucket.get('runtime', 0))
+
+
+def _get_bucket_start(key):
+    """ Returns the timestamp at which a week, month or year bucket starts.
+
+        Weeks are keyed by their timestamp, months by 'YYYY-MM' and years
+        by 'YYYY'.
+    """
+
+    if '-' in key:
+        start = datetime.datetime.strptime(key, '%Y-%m')
+    elif len(key) == 4:
+        start = datetime.datetime.strptime(key, '%Y')
+    else:
+        return int(key)
+
+    return calendar.timegm(start.timetuple())
+
+
+def _week_to_month(week):
+    return datetime.datetime.utcfromtimestamp(int(week)).strftime('%Y-%m')
+
+
+def _month_to_year(month):
+    return month.split('-')[0]
+
+
+def _get_last_used(stats):
+    last_used = 0
+    if not isinstance(stats, dict):
+        return last_used
+
+    for period in ['weekly', 'monthly', 'yearly']:
+        for key in stats.get(period, {}):
+            last_used = max(last_used, _get_bucket_start(key))
+    return last_used
+
+
+def compact_app_stats(app_stats, keep=None):
+    """ Applies the retention policy to the app usage history.
+
+        Keeps the last WEEKS_KEPT weeks of each app, older weeks are rolled
+        into monthly and then yearly totals. Yearly totals older than
+        YEARS_KEPT are dropped, as are the stats of the least recently used
+        apps over MAX_TRACKED_APPS.
+
+        :param app_stats: The 'app_stats' of the tracker, modified in place.
+        :type app_stats: dict
+
+        :param keep: An app whose stats are never dropped, the one being
+            updated.
+        :type keep: str
+    """
+
+    for stats in app_stats.itervalues():
+        if not isinstance(stats, dict):
+            continue
+
+        weekly = stats.get('weekly', {})
+        if len(weekly) > WEEKS_KEPT:
+            _roll_up(weekly, stats.setdefault('monthly', {}), WEEKS_KEPT,
+                     _week_to_month)
+
+        monthly = stats.get('monthly', {})
+        if len(monthly) > MONTHS_KEPT:
+            _roll_up(monthly, stats.setdefault('yearly', {}), MONTHS_KEPT,
+                     _month_to_year)
+
+        yearly = stats.get('yearly', {})
+        if len(yearly) > YEARS_KEPT:
+            _roll_up(yearly, None, YEARS_KEPT, None)
+
+    if len(app_stats) > MAX_TRACKED_APPS:
+        by_recency = sorted((app for app in app_stats if app != keep),
+                            key=lambda app: _get_last_used(app_stats[app]))
+        for app in by_recency[:len(app_stats) - MAX_TRACKED_APPS]:
+            del app_stats[app]
+
+
 def add_runtime_to_app(app, runtime):
     """ Saves the tracking data for a given application.
 
         Appends a time period to a given app's runtime stats and raises
         starts by one. Apart from the total values, it also updates the
-        weekly stats.
+        weekly stats. The history is kept bounded by compact_app_stats().
 
         This function uses advisory file locks (see flock(2)) to avoid
         races between different applications saving their tracking data
@@ -367,14 +590,8 @@ def add_runtime_to_app(app, runtime):
 
     app = app.replace('.', '_')
 
-    # Make sure no one else is accessing this file
-    app_state_file = get_app_state_file('kano-tracker')
-
-    try:
-        tracker_store = open_locked(app_state_file, "r")
-    except IOError as e:
-        logger.error('Error opening app state file {}'.format(e))
-    else:
+    # Make sure no one else is accessing the tracker's state
+    with lock_app_state('kano-tracker'):
         app_stats = load_app_state_variable('kano-tracker', 'app_stats')
         if not app_stats:
             app_stats = dict()
@@ -399,14 +616,14 @@ def add_runtime_to_app(app, runtime):
                 'runtime': 0
             }
 
+            # A new week has started, it's time to roll up the old ones
+            compact_app_stats(app_stats, keep=app)
+
         app_stats[app]['weekly'][week]['starts'] += 1
         app_stats[app]['weekly'][week]['runtime'] += runtime
 
         save_app_state_variable('kano-tracker', 'app_stats', app_stats)
 
-        # Close the lock
-        tracker_store.close()
-
 
 def save_hardware_info():
     """Saves hardware information related to the Raspberry Pi / Kano Kit"""
@@ -443,9 +660,71 @@ def save_kano_version():
     save_app_state_variable('kano-tracker', 'versions', updates)
 
 
+def iter_tracker_events(old_only=False):
+    """ Read the events log one event at a time, starting after the events
+        that were acknowledged already.
+
+        :param old_only: Don't return events from the current boot.
+        :type old_only: boolean
+
+        :returns: The valid events, oldest first, with their sequence
+            number under 'seq'.
+        :rtype: generator
+    """
+
+    for segment, position, event in _iter_segment_events(old_only):
+        if event is not None:
+            yield event
+
+
+def _iter_segment_events(old_only=True):
+    """ Yields (segment, position, event) triples. The position is where
+        the cursor of the segment can move once the event is handled, None
+        if it can't move. After the last event of a segment, one more
+        triple with the event set to None is yielded.
+
+        The events of the current boot are never acknowledged, they're
+        skipped altogether if old_only is set.
+    """
+
+    flush_tracker_events()
+
+    for segment in event_log.get_segments():
+        if old_only and segment['token'] == TOKEN:
+            continue
+
+        position = segment['acked']
+        for offset, end, event in iter_events(segment['path'],
+                                              segment['acked']):
+            if event is None:
+                logger.warn("Found a corrupted event, skipping.")
+
+            if event is None or not _validate_event(event):
+                if position is not None:
+                    position = end
+                continue
+
+            if event['token'] == TOKEN:
+                # The events from here on have to stay
+                position = None
+                if old_only:
+                    continue
+
+            if position is not None:
+                position = end
+
+            event['seq'] = get_sequence_number(segment['id'], offset)
+            yield segment, position, event
+
+        yield segment, position, None
+
+
 def get_tracker_events(old_only=False):
     """ Read the events log and return a dictionary with all of them.
 
+        Use iter_tracker_events() or iter_tracker_event_batches() instead
+        when there can be many events.
+
         :param old_only: Don't return events from the current boot.
         :type old_only: boolean
 
@@ -453,24 +732,72 @@ def get_tracker_events(old_only=False):
         :rtype: dict
     """
 
-    data = {'events': []}
+    return {'events': list(iter_tracker_events(old_only))}
 
-    try:
-        rf = open_locked(tracker_events_file, "r")
-    except IOError as e:
-        logger.error('Error opening the tracker events file {}'.format(e))
-    else:
-        with rf:
-            for event_line in rf.readlines():
-                try:
-                    event = json.loads(event_line)
-                except:
-                    logger.warn("Found a corrupted event, skipping.")
 
-                if _validate_event(event) and event['token'] != TOKEN:
-                    data['events'].append(event)
+# Limits of a single upload to the tracker endpoint
+UPLOAD_BATCH_SIZE = 500
+UPLOAD_BATCH_BYTES = 256 * 1024
+
+
+def iter_tracker_event_batches(max_events=UPLOAD_BATCH_SIZE,
+                               max_bytes=UPLOAD_BATCH_BYTES):
+    """ Split the events of the previous boots into batches to upload.
+
+        Only one batch is held in memory at a time. Once a batch is
+        uploaded, pass its cursor to acknowledge_tracker_events() so its
+        events aren't sent again. Each event carries a sequence number
+        under 'seq' which doesn't change when it's sent again, so the
+        events of a batch that was received but not acknowledged can be
+        told apart.
+
+        :param max_events: Most events in a batch.
+        :type max_events: int
+
+        :param max_bytes: Most bytes of serialised events in a batch. A
+            single bigger event still makes a batch of its own.
+        :type max_bytes: int
+
+        :returns: (data, cursor) pairs. The data is suitable to be sent to
+            the tracker endpoint, the cursor marks how far into the log the
+            events are handled once this batch is uploaded. The last batch
+            can have no events, only a cursor to acknowledge.
+        :rtype: generator
+    """
 
-    return data
+    events = []
+    size = 0
+    cursor = {}
+
+    for segment, position, event in _iter_segment_events(old_only=True):
+        if event is not None:
+            event_size = len(json.dumps(event))
+            if events and (len(events) >= max_events or
+                           size + event_size > max_bytes):
+                yield {'events': events}, cursor
+                events = []
+                size = 0
+                cursor = {}
+
+            events.append(event)
+            size += event_size
+
+        if position is not None:
+            cursor[segment['id']] = position
+
+    if events or cursor:
+        yield {'events': events}, cursor
+
+
+def acknowledge_tracker_events(cursor):
+    """ Mark the events up to a cursor as uploaded, they won't be read
+        again. Segments that are fully uploaded are deleted.
+
+        :param cursor: As returned by iter_tracker_event_batches().
+        :type cursor: dict
+    """
+
+    event_log.acknowledge(cursor)
 
 
 def _validate_event(event):
@@ -509,28 +836,11 @@ def _validate_event(event):
 
 
 def clear_tracker_events(old_only=True):
-    """ Truncate the events file, removing all the cached data.
+    """ Remove the cached events by deleting their segments.
 
         :param old_only: Don't remove data from the current boot.
         :type old_only: boolean
     """
-    try:
-        rf = open_locked(tracker_events_file, "r")
-    except IOError as e:
-        logger.error('Error opening tracking events file {}'.format(e))
-    else:
-        with rf:
-            events = []
-            for event_line in rf.readlines():
-                try:
-                    event = json.loads(event_line)
-                    if 'token' in event and event['token'] == TOKEN:
-                        events.append(event_line)
-                except:
-                    logger.warn("Found a corrupted event, skipping.")
-
-            with open(tracker_events_file, "w") as wf:
-                for event_line in events:
-                    wf.write(event_line)
-            if 'SUDO_USER' in os.environ:
-                chown_path(tracker_events_file)
+
+    flush_tracker_events()
+    event_log.clear(keep_token=TOKEN if old_only else None)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+
+# xp.py
+#
+# Copyright (C) 2015 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+
+"""
+The XP the state of an app is worth according to xp.json
+
+The contributions of all the apps are cached in the stats index,
+see kano_profile.stats.
+"""
+
+
+def calculate_app_xp(groups, appstate):
+    """ Computes the XP the state of a single app is worth.
+
+        :param groups: The rules of the app from xp.json.
+        :type groups: dict
+
+        :param appstate: The state of the app.
+        :type appstate: dict
+
+        :returns: The points, not rounded.
+        :rtype: float
+    """
+
+    points = 0
+    if not appstate:
+        return points
+
+    for group, rules in groups.iteritems():
+        # calculating points based on level
+        if group == 'level' and 'level' in appstate:
+            maxlevel = int(appstate['level'])
+
+            for level, value in rules.iteritems():
+                level = int(level)
+                value = int(value)
+
+                if level <= maxlevel:
+                    points += value
+
+        # calculating points based on multipliers
+        if group == 'multipliers':
+            for thing, value in rules.iteritems():
+                value = float(value)
+                if thing in appstate:
+                    points += value * appstate[thing]
+
+    return points
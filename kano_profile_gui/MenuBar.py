@@ -11,7 +11,7 @@ import os
 from gi.repository import Gtk, GObject
 from kano.gtk3.cursor import attach_cursor_events
 from kano_world.functions import get_mixed_username
-from kano_profile.badges import calculate_kano_level
+from kano_profile.badges import get_profile_snapshot
 from kano_profile_gui.components.icons import get_ui_icon
 
 
@@ -160,7 +160,7 @@ class HomeButton(Gtk.Button):
         title_label = Gtk.Label(username, xalign=0)
         title_label.get_style_context().add_class("home_button_name")
 
-        level, dummy, dummy = calculate_kano_level()
+        level, dummy, dummy = get_profile_snapshot().level
         level_label = Gtk.Label(_("Level {}").format(level), xalign=0)
         level_label.get_style_context().add_class("home_button_level")
 
@@ -6,18 +6,20 @@
 # License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
 #
 
-from kano_profile.badges import calculate_badges
+from kano_profile.badges import get_profile_snapshot
 
 
 def filter_item_info():
     '''This is a dictionary of the names and the corresponding
     bg colour, badge description etc.
     '''
-    badge_dictionary = calculate_badges()['badges']
+    badge_dictionary = get_profile_snapshot().badges['badges']
     badge_list = []
 
     for category, cat_dict in badge_dictionary.iteritems():
         for filename, item_dict in cat_dict.iteritems():
+            # The snapshot is shared, work on a copy
+            item_dict = dict(item_dict)
             if 'order' not in item_dict:
                 item_dict['order'] = 0
             item_dict['category'] = category
@@ -8,9 +8,9 @@
 
 import os
 from gi.repository import Gtk
-from kano.utils import get_home, read_json
+from kano.utils import get_home
 from kano_profile.apps import get_app_list, get_app_data_dir, launch_project
-from kano_profile.paths import app_profiles_file
+from kano_profile.rules import load_rules
 from kano.logging import logger
 import kano.gtk3.cursor as cursor
 from kano.gtk3.scrolled_window import ScrolledWindow
@@ -18,7 +18,7 @@ import kano_profile_gui.components.icons as icons
 from .paths import image_dir
 from kdesk.hourglass import hourglass_start, hourglass_end
 
-app_profiles = read_json(app_profiles_file)
+app_profiles = load_rules()['app_profiles']
 
 
 # The list of the displayed items
@@ -6,46 +6,65 @@
 # License: http://www.gnu.org/licenses/gpl-2.0.txt GNU General Public License v2
 #
 
-from kano_profile.apps import load_app_state_variable, save_app_state_variable
+from kano_profile.apps import load_app_state_variable, update_app_state
+
+CACHE_APP = "kano-avatar-registration"
+CACHED_CATEGORIES = [
+    "username",
+    "email",
+    "secondary_email",
+    "birthday_day",
+    "birthday_month",
+    "birthday_year",
+    "birthday_day_index",
+    "birthday_month_index",
+    "birthday_year_index",
+    "marketing_enabled",
+]
 
 
 def cache_data(category, value):
-    if category in [
-        "username",
-        "email",
-        "secondary_email",
-        "birthday_day",
-        "birthday_month",
-        "birthday_year",
-        "birthday_day_index",
-        "birthday_month_index",
-        "birthday_year_index",
-        "marketing_enabled",
-    ]:
-        save_app_state_variable("kano-avatar-registration", category, value)
+    cache_many({category: value})
+
+
+def cache_many(values):
+    """ Cache several categories with a single write to the app state. """
+
+    updates = dict((category, value) for category, value in values.iteritems()
+                   if category in CACHED_CATEGORIES)
+    if updates:
+        update_app_state(CACHE_APP, updates=updates)
 
 
 def get_cached_data(category):
-    return load_app_state_variable("kano-avatar-registration", category)
+    return load_app_state_variable(CACHE_APP, category)
 
 
 def cache_birthday(day, month, year):
-    cache_data("birthday_day", day)
-    cache_data("birthday_month", month)
-    cache_data("birthday_year", year)
+    cache_many({
+        "birthday_day": day,
+        "birthday_month": month,
+        "birthday_year": year,
+    })
 
 
 def cache_emails(email, secondary_email="", email_user=False):
-    cache_data("email", email)
-    cache_data("secondary_email", secondary_email)
-    cache_data("email_user", email_user)
+    cache_many({
+        "email": email,
+        "secondary_email": secondary_email,
+        "email_user": email_user,
+    })
 
 
 def cache_all(email, secondary_email, username,
               birthday_day, birthday_month, birthday_year,
               marketing_enabled):
-    cache_birthday(birthday_day, birthday_month, birthday_year)
-    cache_data("email", email)
-    cache_data("secondary_email", secondary_email)
-    cache_data("username", username)
-    cache_data("marketing_enabled", marketing_enabled)
+    cache_many({
+        "birthday_day": birthday_day,
+        "birthday_month": birthday_month,
+        "birthday_year": birthday_year,
+        "email": email,
+        "secondary_email": secondary_email,
+        "username": username,
+        "marketing_enabled": marketing_enabled,
+    })
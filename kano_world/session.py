@@ -15,15 +15,20 @@ import json
 import os
 
 from kano.logging import logger
-from kano.utils import download_url, read_json, ensure_dir, chown_path
+from kano.utils import download_url, read_json, ensure_dir
 from kano_profile.profile import (load_profile, set_avatar, set_environment,
                                   save_profile, save_profile_variable,
                                   recreate_char)
-from kano_profile.badges import calculate_xp
-from kano_profile.apps import get_app_list, load_app_state, save_app_state
-from kano_profile.paths import app_profiles_file, online_badges_dir, \
-    online_badges_file, profile_dir
-from kano_profile.tracker import get_tracker_events, clear_tracker_events
+from kano_profile.badges import get_profile_snapshot
+from kano_profile.apps import get_app_list, load_all_app_states, \
+    save_app_state
+from kano_profile.atomic import write_file_atomic
+from kano_profile.ownership import fix_ownership
+from kano_profile.paths import online_badges_dir, online_badges_file, \
+    profile_dir
+from kano_profile.rules import load_rules
+from kano_profile.tracker import iter_tracker_event_batches, \
+    acknowledge_tracker_events
 from kano_profile_gui.paths import media_dir
 from kano_avatar.paths import (AVATAR_DEFAULT_LOC, AVATAR_DEFAULT_NAME,
                                AVATAR_ENV_DEFAULT,
@@ -31,12 +36,10 @@ from kano_avatar.paths import (AVATAR_DEFAULT_LOC, AVATAR_DEFAULT_NAME,
 
 from .connection import request_wrapper, content_type_json
 
-app_profiles_data = read_json(app_profiles_file)
-
 
 def is_private(app_name):
     try:
-        private = app_profiles_data[app_name]['private']
+        private = load_rules()['app_profiles'][app_name]['private']
     except Exception:
         private = False
     return private
@@ -60,7 +63,7 @@ class KanoWorldSession(object):
         data = dict()
 
         # xp
-        data['xp'] = calculate_xp()
+        data['xp'] = get_profile_snapshot().xp
 
         # version
         try:
@@ -91,9 +94,10 @@ class KanoWorldSession(object):
         data, files = self._prepare_avatar_gen(profile, data)
         # app states
         stats = dict()
+        app_states = load_all_app_states()
         for app in get_app_list():
             if not is_private(app):
-                stats[app] = load_app_state(app)
+                stats[app] = app_states.get(app, dict())
 
         # append stats
         data['stats'] = stats
@@ -244,9 +248,10 @@ class KanoWorldSession(object):
 
     def upload_private_data(self):
         data = dict()
+        app_states = load_all_app_states()
         for app in get_app_list():
             if is_private(app):
-                data[app] = load_app_state(app)
+                data[app] = app_states.get(app, dict())
 
         payload = dict()
         payload['data'] = data
@@ -431,23 +436,31 @@ class KanoWorldSession(object):
         return rv, error
 
     def upload_tracking_data(self):
-        data = get_tracker_events(old_only=True)
-        if len(data['events']) == 0:
-            return True, "No data available"
+        # The events are sent in batches, each of them is acknowledged
+        # once it's accepted, so a failure only leaves the rest to retry
+        uploaded = 0
+        for data, cursor in iter_tracker_event_batches():
+            if data['events']:
+                success, text, response_data = request_wrapper(
+                    'post',
+                    '/tracking',
+                    headers=content_type_json,
+                    session=self.session,
+                    data=json.dumps(data)
+                )
 
-        success, text, response_data = request_wrapper(
-            'post',
-            '/tracking',
-            headers=content_type_json,
-            session=self.session,
-            data=json.dumps(data)
-        )
+                if not success or 'success' not in response_data or \
+                        not response_data['success']:
+                    return False, "Upload failed, tracking data not sent."
 
-        if success and 'success' in response_data and response_data['success']:
-            clear_tracker_events(old_only=True)
-            return True, None
+                uploaded += len(data['events'])
 
-        return False, "Upload failed, tracking data not sent."
+            acknowledge_tracker_events(cursor)
+
+        if not uploaded:
+            return True, "No data available"
+
+        return True, None
 
     def download_online_badges(self):
         profile = load_profile()
@@ -501,16 +514,13 @@ class KanoWorldSession(object):
         try:
             may_write = True
             txt = None
-            f = open(online_badges_file, "w")
-        except IOError as e:
+            write_file_atomic(online_badges_file,
+                              json.dumps(online_badges_data))
+        except (IOError, OSError) as e:
             may_write = False
-            txt = 'Error opening badges file {}'.format(str(e))
+            txt = 'Error writing badges file {}'.format(str(e))
         else:
-            with f:
-                f.write(json.dumps(online_badges_data))
-            if 'SUDO_USER' in os.environ:
-                chown_path(online_badges_dir)
-                chown_path(online_badges_file)
+            fix_ownership(online_badges_dir, online_badges_file)
 
         return may_write, txt
 
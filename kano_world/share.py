@@ -9,8 +9,8 @@
 import os
 from slugify import slugify
 
-from kano.utils import get_home, download_url, ensure_dir, read_json, write_json
-from kano_profile.paths import app_profiles_file
+from kano.utils import get_home, download_url, ensure_dir, write_json
+from kano_profile.rules import load_rules
 from kano.logging import logger
 from .connection import request_wrapper, content_type_json
 from .functions import get_glob_session, get_kano_world_id
@@ -143,7 +143,7 @@ def download_share(entry):
         'description': description
     }
 
-    app_profiles = read_json(app_profiles_file)
+    app_profiles = load_rules()['app_profiles']
 
     if app not in app_profiles:
         logger.error('Cannot download share, app not found in app-profiles')
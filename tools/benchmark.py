@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+
+# benchmark.py
+#
+# Copyright (C) 2015 Kano Computing Ltd.
+# License: http://www.gnu.org/licenses/gpl-2.0.txt GNU GPL v2
+#
+
+"""
+Benchmarks the XP and badge engine on a synthetic profile
+
+A profile and a set of rules of the given size are generated in a temporary
+directory, which is then used through the KANO_PROFILE_HOME and
+KANO_PROFILE_RULES environment variables. Each entry point is run in a few
+fresh processes: the first call in a process is the cold one, the following
+calls are warm. The time, the I/O counters from /proc/self/io and the number
+of files opened are recorded for every call and written as JSON, so results
+of different versions can be compared.
+
+The notifications shown by save_app_state_with_dialog() (sounds, kano-sync)
+are disabled, they run in the background and aren't part of the engine.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import platform
+import subprocess
+
+if __name__ == '__main__' and __package__ is None:
+    dir_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    if dir_path != '/usr':
+        sys.path.insert(1, dir_path)
+
+# Don't import kano_profile at the module level, the paths are fixed on
+# import and have to point to the synthetic profile first
+
+ENTRY_POINTS = ['calculate_xp', 'calculate_badges',
+                'save_app_state_with_dialog', 'count_badges']
+
+IO_COUNTERS = ['rchar', 'wchar', 'syscr', 'syscw', 'read_bytes',
+               'write_bytes']
+
+RESULTS_VERSION = 1
+
+
+def generate_rules(rules_dir, num_apps, num_variables, num_rules, rng):
+    """ Writes xp.json, levels.json, app_profiles.json and the badge rules.
+
+        Every app gets a 'level' table and multipliers for half of its
+        variables. The badges depend on one to three random variables each,
+        a few depend on the level, so the pushed back rules are exercised
+        as well.
+    """
+
+    apps = ['app-{:03d}'.format(i) for i in xrange(num_apps)]
+    variables = ['var_{:03d}'.format(i) for i in xrange(num_variables)]
+
+    xp = dict()
+    app_profiles = dict()
+    for app in apps:
+        xp[app] = {
+            'level': dict((str(level), rng.randint(5, 50))
+                          for level in xrange(1, 11)),
+            'multipliers': dict((variable, rng.choice([0.01, 0.1, 1]))
+                                for variable in variables[::2])
+        }
+        app_profiles[app] = {'max_level': 10}
+
+    levels = dict((str(level), (level - 1) ** 2 * 50)
+                  for level in xrange(1, 31))
+
+    badges = dict()
+    for i in xrange(num_rules):
+        badge = {
+            'title': 'Badge {}'.format(i),
+            'desc_locked': 'Locked',
+            'desc_unlocked': 'Unlocked',
+            'bg_color': 'ffffff'
+        }
+        targets = [[rng.choice(apps), rng.choice(variables)]
+                   for _ in xrange(rng.randint(1, 3))]
+
+        if i % 20 == 0:
+            badge['operation'] = 'each_greater'
+            badge['targets'] = [['computed', 'kano_level', rng.randint(1, 10)]]
+        elif i % 2:
+            badge['operation'] = 'sum_greater'
+            badge['targets'] = targets
+            badge['value'] = rng.randint(1, 2000)
+        else:
+            badge['operation'] = 'each_greater'
+            badge['targets'] = [target + [rng.randint(1, 1000)]
+                                for target in targets]
+
+        # 20 badges per file, the way the real rules are split up
+        subcat = 'group_{:03d}'.format(i // 20)
+        badges.setdefault(subcat, dict())['badge_{:04d}'.format(i)] = badge
+
+    environments = {
+        'all': dict(('env_{:02d}'.format(i), {
+            'operation': 'each_greater',
+            'targets': [['computed', 'kano_level', i + 1]],
+            'title': 'Environment {}'.format(i),
+            'desc_locked': 'Locked',
+            'desc_unlocked': 'Unlocked'
+        }) for i in xrange(10))
+    }
+
+    _write_json(os.path.join(rules_dir, 'xp.json'), xp)
+    _write_json(os.path.join(rules_dir, 'levels.json'), levels)
+    _write_json(os.path.join(rules_dir, 'app_profiles.json'), app_profiles)
+    for folder, subcats in [('badges', badges),
+                            ('environments', environments)]:
+        for subcat, items in subcats.iteritems():
+            _write_json(os.path.join(rules_dir, folder,
+                                     '{}.json'.format(subcat)), items)
+
+    return apps, variables
+
+
+def generate_app_state(variables, state_size, rng):
+    """ A state with all the variables set and a history of state_size
+        entries, standing in for the data the apps keep next to their
+        counters.
+    """
+
+    state = dict((variable, rng.randint(0, 1000)) for variable in variables)
+    state['level'] = rng.randint(0, 10)
+    state['history'] = [{'time': i, 'value': rng.random()}
+                        for i in xrange(state_size)]
+    return state
+
+
+def _write_json(path, data):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+
+def _read_io_counters():
+    counters = dict((name, 0) for name in IO_COUNTERS)
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                name, value = line.split(':')
+                if name in counters:
+                    counters[name] = int(value)
+    except IOError:
+        pass
+    return counters
+
+
+class _OpenCounter(object):
+    """ Counts the files opened through Python. The SQLite
+        database is opened by the library itself and only shows in the
+        /proc/self/io counters.
+    """
+
+    def __init__(self):
+        import __builtin__
+
+        self.count = 0
+        self._builtins = __builtin__
+        self._open = __builtin__.open
+        self._os_open = os.open
+
+    def install(self):
+        def counting_open(*args, **kwargs):
+            self.count += 1
+            return self._open(*args, **kwargs)
+
+        def counting_os_open(*args, **kwargs):
+            self.count += 1
+            return self._os_open(*args, **kwargs)
+
+        self._builtins.open = counting_open
+        os.open = counting_os_open
+
+
+def run_entry_point(entry_point, calls, apps, variables, result_file):
+    """ Runs in the child process, times the calls of one entry point. """
+
+    from kano_profile import badges
+    from kano_profile.apps import load_app_state
+    from kano_profile.cache import get_cache_stats
+    from kano_profile.atomic import get_write_stats
+
+    badges.run_bg = lambda cmd: None
+    badges.is_gui = lambda: False
+
+    rng = random.Random(0)
+    open_counter = _OpenCounter()
+    open_counter.install()
+
+    def get_call(i):
+        if entry_point != 'save_app_state_with_dialog':
+            return getattr(badges, entry_point)
+
+        app = apps[i % len(apps)]
+        data = load_app_state(app)
+        data[rng.choice(variables)] = rng.randint(0, 2000)
+        return lambda: badges.save_app_state_with_dialog(app, data)
+
+    samples = []
+    for i in xrange(calls):
+        call = get_call(i)
+
+        io_before = _read_io_counters()
+        opens_before = open_counter.count
+        misses_before = sum(c['misses'] for c in get_cache_stats().values())
+        writes_before = get_write_stats()['writes']
+        start = time.time()
+
+        call()
+
+        elapsed = time.time() - start
+        opens = open_counter.count - opens_before
+        io_after = _read_io_counters()
+        sample = dict((name, io_after[name] - io_before[name])
+                      for name in IO_COUNTERS)
+        sample.update({
+            'time': elapsed,
+            'opens': opens,
+            'cache_misses': sum(c['misses'] for c in
+                                get_cache_stats().values()) - misses_before,
+            'atomic_writes': get_write_stats()['writes'] - writes_before
+        })
+        samples.append(sample)
+
+    with open(result_file, 'w') as f:
+        json.dump(samples, f)
+
+
+def _spawn(args, env):
+    cmd = [sys.executable, os.path.abspath(__file__)] + args
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(cmd, env=env, stdout=devnull)
+
+
+def _summarize(samples):
+    times = sorted(sample['time'] for sample in samples)
+    summary = {
+        'calls': len(samples),
+        'min_ms': times[0] * 1000,
+        'median_ms': times[len(times) // 2] * 1000,
+        'mean_ms': sum(times) / len(times) * 1000,
+        'max_ms': times[-1] * 1000
+    }
+    for name in IO_COUNTERS + ['opens', 'cache_misses', 'atomic_writes']:
+        summary[name] = sum(sample[name] for sample in samples) / \
+            float(len(samples))
+    return summary
+
+
+def run_benchmark(args):
+    work_dir = tempfile.mkdtemp(prefix='kano-profile-benchmark.')
+    home = os.path.join(work_dir, 'home')
+    rules_dir = os.path.join(work_dir, 'rules')
+
+    env = dict(os.environ)
+    env['KANO_PROFILE_HOME'] = home
+    env['KANO_PROFILE_RULES'] = rules_dir
+    if args.store:
+        env['KANO_PROFILE_STORE'] = args.store
+    if args.fsync:
+        env['KANO_PROFILE_FSYNC'] = args.fsync
+
+    try:
+        rng = random.Random(args.seed)
+        apps, variables = generate_rules(rules_dir, args.apps,
+                                         args.variables, args.rules, rng)
+        states = dict((app, generate_app_state(variables, args.state_size,
+                                               rng))
+                      for app in apps)
+        _write_json(os.path.join(work_dir, 'states.json'), states)
+        _write_json(os.path.join(work_dir, 'names.json'),
+                    {'apps': apps, 'variables': variables})
+
+        # Save the states and build the caches on the disk (rules bundle,
+        # stats index) in their own process
+        _spawn(['--setup', work_dir], env)
+
+        results = []
+        for entry_point in args.entry_points:
+            cold = []
+            warm = []
+            for run in xrange(args.runs):
+                if args.drop_caches:
+                    kanoprofile_dir = os.path.join(home, '.kanoprofile')
+                    for name in ['rules.cache', 'stats_index.json',
+                                 'apps.index.json']:
+                        path = os.path.join(kanoprofile_dir, name)
+                        if os.path.exists(path):
+                            os.unlink(path)
+
+                result_file = os.path.join(work_dir, 'result.json')
+                _spawn(['--child', work_dir, entry_point,
+                        str(args.calls + 1), result_file], env)
+                with open(result_file) as f:
+                    samples = json.load(f)
+                cold.append(samples[0])
+                warm += samples[1:]
+
+            for phase, samples in [('cold', cold), ('warm', warm)]:
+                if not samples:
+                    continue
+                result = _summarize(samples)
+                result.update({'entry_point': entry_point, 'phase': phase})
+                results.append(result)
+    finally:
+        if args.keep:
+            sys.stderr.write('Profile kept in {}\n'.format(work_dir))
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        'version': RESULTS_VERSION,
+        'created': time.time(),
+        'config': {
+            'apps': args.apps,
+            'variables': args.variables,
+            'rules': args.rules,
+            'state_size': args.state_size,
+            'runs': args.runs,
+            'calls': args.calls,
+            'seed': args.seed,
+            'drop_caches': args.drop_caches,
+            'store': env.get('KANO_PROFILE_STORE'),
+            'fsync': env.get('KANO_PROFILE_FSYNC')
+        },
+        'platform': {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'node': platform.node()
+        },
+        'results': results
+    }
+
+
+def setup_profile(work_dir):
+    """ Runs in a child process, saves the generated states. """
+
+    from kano_profile.storage import get_store
+    from kano_profile.badges import calculate_badges, count_badges
+
+    with open(os.path.join(work_dir, 'states.json')) as f:
+        states = json.load(f)
+
+    store = get_store()
+    for app, state in states.iteritems():
+        app_dir = store.get_app_dir(app)
+        if not os.path.isdir(app_dir):
+            os.makedirs(app_dir)
+        store.save(app, state)
+
+    # The files are only trusted by the caches once they are a bit older
+    time.sleep(0.1)
+    calculate_badges()
+    count_badges()
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '--setup':
+        setup_profile(sys.argv[2])
+        return
+
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        work_dir, entry_point, calls, result_file = sys.argv[2:6]
+        with open(os.path.join(work_dir, 'names.json')) as f:
+            names = json.load(f)
+        run_entry_point(entry_point, int(calls), names['apps'],
+                        names['variables'], result_file)
+        return
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark the XP and badge engine')
+    parser.add_argument('--apps', type=int, default=20,
+                        help='number of apps with XP rules')
+    parser.add_argument('--variables', type=int, default=10,
+                        help='number of variables in each app state')
+    parser.add_argument('--rules', type=int, default=200,
+                        help='number of badge rules')
+    parser.add_argument('--state-size', type=int, default=100,
+                        help='extra entries stored in each app state')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='fresh processes per entry point')
+    parser.add_argument('--calls', type=int, default=10,
+                        help='warm calls in each process')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--store', help='app state backend (json, sqlite)')
+    parser.add_argument('--fsync', help='fsync policy (none, fdatasync, '
+                                        'fsync)')
+    parser.add_argument('--drop-caches', action='store_true',
+                        help='delete the rules bundle and the stats index '
+                             'before every cold call')
+    parser.add_argument('--keep', action='store_true',
+                        help="don't delete the generated profile")
+    parser.add_argument('-o', '--output', help='write the results here')
+    parser.add_argument('entry_points', nargs='*', metavar='entry_point',
+                        default=ENTRY_POINTS,
+                        help='what to benchmark, one of {}'.format(
+                            ', '.join(ENTRY_POINTS)))
+    args = parser.parse_args()
+
+    for entry_point in args.entry_points:
+        if entry_point not in ENTRY_POINTS:
+            parser.error('unknown entry point {}'.format(entry_point))
+
+    report = run_benchmark(args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -15,19 +15,17 @@ if __name__ == '__main__' and __package__ is None:
         sys.path.insert(1, dir_path)
 
 from kano_profile.badges import load_badge_rules
-from slugify import slugify
+from kano_profile.rules import check_badge_names
 
 all_rules = load_badge_rules()
 
-ok = True
-for category, subcats in all_rules.iteritems():
-    for subcat, items in subcats.iteritems():
-        for item, rules in items.iteritems():
-            slug = slugify(rules['title']).replace('-', '_')
-            if item != slug:
-                print item, slug
-                ok = False
+try:
+    problems = check_badge_names(all_rules)
+except ImportError:
+    print 'python-slugify is not installed, the names were not checked'
+    sys.exit(1)
+for problem in problems:
+    print problem
 
-
-if ok:
+if not problems:
     print 'All names are OK'
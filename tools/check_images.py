@@ -15,44 +15,13 @@ if __name__ == '__main__' and __package__ is None:
         sys.path.insert(1, dir_path)
 
 from kano_profile.badges import load_badge_rules
-from kano_profile_gui.paths import image_dir
-# from kano.utils import uniqify_list
-
+from kano_profile.rules import check_badge_images
 
 all_rules = load_badge_rules()
 
-ok = True
-for category, subcats in all_rules.iteritems():
-    for subcat, items in subcats.iteritems():
-        path = os.path.join(image_dir, category, 'originals', subcat)
-
-        existing_items = sorted([f for f in os.listdir(path)])
-        needed_items_images = ['{}.png'.format(f) for f in items.keys()]
-        needed_items_locked = ['{}_locked.png'.format(f) for f in items.keys()]
-        needed_items_circular = ['{}_circular.png'.format(f) for f in items.keys()]
-        needed_items_white_circular = ['{}_white_circular.png'.format(f) for f in items.keys()]
-        # needed_items_levelup = ['{}_levelup.png'.format(f) for f in items.keys()]
-
-        if category == 'badges':
-            needed_items = needed_items_images + needed_items_locked
-
-        if category == 'environments':
-            needed_items = needed_items_images + needed_items_locked
-
-        needed_items = sorted(needed_items)
-
-        if sorted(existing_items) != sorted(needed_items):
-            print category, subcat
-            for e in existing_items:
-                if e not in needed_items:
-                    print 'Leftover image: {}'.format(e)
-
-            for n in needed_items:
-                if n not in existing_items:
-                    print 'Needed image: {}'.format(n)
-
-            print
-            ok = False
+problems = check_badge_images(all_rules)
+for problem in problems:
+    print problem
 
-if ok:
+if not problems:
     print 'All images are OK!'
@@ -15,16 +15,9 @@ if __name__ == '__main__' and __package__ is None:
         sys.path.insert(1, dir_path)
 
 from kano_profile.badges import load_badge_rules
+from kano_profile.rules import find_online_badges
 
 all_rules = load_badge_rules()
 
-variables_needed = dict()
-
-for category, subcats in all_rules.iteritems():
-    for subcat, items in subcats.iteritems():
-        for item, rules in items.iteritems():
-            targets = rules['targets']
-            for target in targets:
-                app = target[0]
-                if app == 'online':
-                    print category, subcat, item
+for category, subcat, item in find_online_badges(all_rules):
+    print category, subcat, item